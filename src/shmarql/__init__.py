@@ -1,4 +1,29 @@
+import sys, time
+
+_import_start, _modules_before = time.time(), set(sys.modules)
+
 from .main import app
 from .markdownplugin import makeExtension, ShmarqlLexer
+from .config import log
+
+# Heavy dependencies that are only imported when first used, by charts, the
+# /bikidata routes or the first query, which needs fizzysearch
+LAZY_IMPORTS = ("pandas", "plotly", "rdflib", "bikidata", "cohere")
+
+
+def report_imports(start: float, before: set):
+    "Log how long importing shmarql took, and which packages it brought in."
+    imported = sorted({name.split(".")[0] for name in set(sys.modules) - before})
+    log.info(
+        f"Imported shmarql in {time.time() - start:.2f} seconds,"
+        f" {len(imported)} packages"
+    )
+    log.debug(f"Imported packages: {', '.join(imported)}")
+    eager = [name for name in LAZY_IMPORTS if name in imported]
+    if eager:
+        log.debug(f"Imported at startup, and not on first use: {', '.join(eager)}")
+
+
+report_imports(_import_start, _modules_before)
 
 # from .am import login_required
@@ -1,7 +1,13 @@
 import os, click, zipfile
-from shmarql.config import log
+import pyoxigraph as px
+from shmarql.config import log, BIKIDATA_DB, SITEDOCS_PATH
 from mkdocs.__main__ import cli as mkdocs_cli
 from .am import reset_admin_password
+from .loader import lock_store, read_manifest
+from . import fts
+from .fts import update_index, graph_signatures
+from .qry import load_store
+from .assets import compress_files
 
 
 @click.option(
@@ -50,6 +56,59 @@ def init_site(dirname: str = "shmarql_site"):
         log.error(str(e))
 
 
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(),
+    help="Directory to build the store in",
+    required=True,
+)
+@click.argument("data_load_paths", nargs=-1, required=True)
+@click.command("build_store")
+def build_store(output: str, data_load_paths: tuple):
+    """
+    Builds a store from the given files, directories and URLs, and the bikidata
+    index if BIKIDATA_DB is set. Serve it read-only by setting STORE_PATH to the
+    output directory, and STORE_VERSION to the data version that is reported.
+    Running it again on the same output only loads what changed.
+    """
+    lock = lock_store(output)
+    if lock is None:
+        log.error(f"Another process is loading the store at {output}")
+        return
+    try:
+        ready = load_store(list(data_load_paths), output)
+        # Compact it, the store will not be written to anymore once it is served
+        store = px.Store(output)
+        store.optimize()
+        # Importing shmarql may have started updating the index in the background,
+        # which would be cut off when this exits, so wait for it and update after
+        if fts.INDEX_UPDATE:
+            fts.INDEX_UPDATE.join()
+        graphs = graph_signatures(store, read_manifest(output))
+        if BIKIDATA_DB and not update_index(store, graphs, BIKIDATA_DB, wait=True):
+            raise click.ClickException(f"Building the index {BIKIDATA_DB} failed")
+        del store
+    finally:
+        lock.close()
+    log.info(
+        f"Store built at {output} with {ready['quads']} quads,"
+        f" data version {ready['version']}"
+    )
+
+
+@click.argument("paths", nargs=-1)
+@click.command("compress_static")
+def compress_static(paths: tuple):
+    """
+    Writes precompressed .gz and .br (if the brotli package is installed) versions
+    of the text files in the site and static directories, or the given paths, which
+    are then sent to browsers that accept them. Run it after docs_build.
+    """
+    written = compress_files(list(paths) or [SITEDOCS_PATH, "static"])
+    log.info(f"Wrote {written} compressed files")
+
+
 @click.group()
 def cli():
     pass
@@ -58,6 +117,8 @@ def cli():
 cli.add_command(docs_build)
 cli.add_command(reset_admin)
 cli.add_command(init_site)
+cli.add_command(build_store)
+cli.add_command(compress_static)
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,165 @@
+import gzip, mimetypes, os, re
+from fastapi import Request
+from fastapi.responses import Response, FileResponse
+from .config import STATIC_MAX_AGE, STATIC_RELOAD, log
+from .loader import file_hash
+
+# Names with a content hash in them, like mkdocs-material's bundle.f1b2c3d4.min.js,
+# change name when their content changes, so browsers can keep them forever
+HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+# Precompressed siblings, in order of preference
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+COMPRESSIBLE = (".html", ".css", ".js", ".json", ".svg", ".xml", ".txt", ".map")
+
+
+def accepted_encodings(header: str) -> dict:
+    "The encodings in an Accept-Encoding header, with their q-values."
+    accepted = {}
+    for part in header.split(","):
+        encoding, *params = [param.strip() for param in part.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0
+        if encoding:
+            accepted[encoding.lower()] = q
+    return accepted
+
+
+class StaticFile:
+    def __init__(self, path: str, name: str):
+        self.path = path
+        self.stat = os.stat(path)
+        self.hash = None
+        self.media_type = mimetypes.guess_type(name)[0] or "text/plain"
+        if HASHED_NAME.search(os.path.basename(name)):
+            self.cache_control = "public, max-age=31536000, immutable"
+        else:
+            self.cache_control = f"public, max-age={STATIC_MAX_AGE}"
+        self.variants = {}
+        for encoding, extension in ENCODINGS:
+            try:
+                stat = os.stat(path + extension)
+            except FileNotFoundError:
+                continue
+            # Otherwise it was compressed from an older version of the file
+            if stat.st_mtime_ns >= self.stat.st_mtime_ns:
+                self.variants[encoding] = (path + extension, stat)
+
+    @property
+    def etag(self) -> str:
+        # Hashed when first asked for, so that startup does not read every file
+        if self.hash is None:
+            self.hash = file_hash(self.path)
+        return f'"{self.hash}"'
+
+
+class StaticFiles:
+    """The files below root, with their ETag and precompressed variants, listed once
+    at startup. A request for something that is not one of them does not touch the
+    disk. Files that are added later are only served after a restart. Files that
+    change are only noticed with reload, by checking their stat on every request."""
+
+    def __init__(self, root: str, reload: bool = STATIC_RELOAD):
+        self.reload = reload
+        self.files = {}
+        for dirpath, _, filenames in os.walk(root, followlinks=True):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                name = os.path.relpath(path, root).replace(os.sep, "/")
+                try:
+                    self.files[name] = StaticFile(path, name)
+                except OSError as e:
+                    # Like a dangling symlink
+                    log.warning(f"Not serving {path}: {e}")
+        log.debug(f"Serving {len(self.files)} files from {root}")
+
+    def current(self, name: str) -> StaticFile:
+        "The file called name, checked against the disk if reloading, or None."
+        f = self.files.get(name)
+        if f is None or not self.reload:
+            return f
+        try:
+            stat = os.stat(f.path)
+            if (stat.st_mtime_ns, stat.st_size) != (f.stat.st_mtime_ns, f.stat.st_size):
+                f = self.files[name] = StaticFile(f.path, name)
+                log.debug(f"{f.path} changed")
+        except OSError:
+            del self.files[name]
+            return None
+        return f
+
+    def response(self, request: Request, name: str) -> Response:
+        "The response for the file called name, or None if there is no such file."
+        f = self.current(name)
+        if f is None:
+            return None
+        path, stat, etag = f.path, f.stat, f.etag
+        headers = {"Cache-Control": f.cache_control}
+        if f.variants:
+            headers["Vary"] = "Accept-Encoding"
+        accepted = accepted_encodings(request.headers.get("accept-encoding", ""))
+        # The one the browser prefers, of equals the first in ENCODINGS
+        best = 0
+        for encoding, (variant_path, variant_stat) in f.variants.items():
+            q = accepted.get(encoding, accepted.get("*", 0))
+            if q > best:
+                best, path, stat = q, variant_path, variant_stat
+                # Strong ETags are per representation
+                etag = f'{f.etag[:-1]}-{encoding}"'
+                headers["Content-Encoding"] = encoding
+        headers["ETag"] = etag
+
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match:
+            tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+            if etag in tags or "*" in tags:
+                headers.pop("Content-Encoding", None)
+                return Response(status_code=304, headers=headers)
+        return FileResponse(
+            path, stat_result=stat, media_type=f.media_type, headers=headers
+        )
+
+
+def compress_files(roots: list) -> int:
+    """Write .gz, and .br if the brotli package is installed, next to the text files
+    below roots that are worth compressing. Files that already have up to date
+    siblings are skipped. Returns the number of files written."""
+    try:
+        import brotli
+    except ImportError:
+        log.info("The brotli package is not installed, only writing .gz files")
+        brotli = None
+    written = 0
+    for root in roots:
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                if not filename.endswith(COMPRESSIBLE):
+                    continue
+                path = os.path.join(dirpath, filename)
+                mtime = os.stat(path).st_mtime_ns
+                data = None
+                for extension, compress in (
+                    (".gz", lambda data: gzip.compress(data, 9, mtime=0)),
+                    (".br", brotli.compress if brotli else None),
+                ):
+                    if compress is None:
+                        continue
+                    try:
+                        if os.stat(path + extension).st_mtime_ns >= mtime:
+                            continue
+                    except FileNotFoundError:
+                        pass
+                    if data is None:
+                        with open(path, "rb") as f:
+                            data = f.read()
+                    compressed = compress(data)
+                    if len(compressed) >= len(data):
+                        continue
+                    with open(path + extension, "wb") as f:
+                        f.write(compressed)
+                    written += 1
+    return written
@@ -1,6 +1,5 @@
 from fasthtml.common import *
 import json
-import bikidata
 from .main import app
 from .config import MOUNT
 
@@ -57,6 +56,8 @@ async def query(request: Request):
     body = await request.body()
     opts = json.loads(body)
     try:
+        import bikidata
+
         r = bikidata.query(opts)
     except Exception as e:
         r = {"error": str(e)}
@@ -108,6 +109,8 @@ def biki_browse():
     <path d="M9.5 1a.5.5 0 0 1 .5.5v1a.5.5 0 0 1-.5.5h-3a.5.5 0 0 1-.5-.5v-1a.5.5 0 0 1 .5-.5h3zm-3-1A1.5 1.5 0 0 0 5 1.5v1A1.5 1.5 0 0 0 6.5 4h3A1.5 1.5 0 0 0 11 2.5v-1A1.5 1.5 0 0 0 9.5 0h-3z"/>
 </svg>"""
 
+    import bikidata
+
     props = bikidata.query({"aggregates": ["properties"]})
     props = sorted(
         [
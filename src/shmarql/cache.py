@@ -0,0 +1,69 @@
+import time
+from collections import OrderedDict
+from .config import LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL, log
+
+
+class LRUCache:
+    """An in-process cache bounded by the (approximate) number of bytes of the
+    values it holds, evicting the least recently used entries first.
+    Entries expire ttl seconds after they were added."""
+
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expires, size, value)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, _, value = entry
+        if expires < time.monotonic():
+            self.remove(key)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value, size: int):
+        self.remove(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, size, value)
+        self.size += size
+        while self.size > self.max_bytes:
+            evicted, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+            log.debug(f"Evicted {evicted} from local cache")
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+LOCAL_CACHE = LRUCache(LOCAL_CACHE_SIZE, LOCAL_CACHE_TTL)
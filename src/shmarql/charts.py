@@ -1,13 +1,16 @@
+import io, re
+import numpy as np
 import pandas as pd
 import plotly.express as px
-from .px_util import do_prefixes
+from .config import MAP_MAX_POINTS
+from .px_util import prefix_column
 
 
 def do_barchart(settings: dict, data: pd.DataFrame, label=None):
     x_col = settings.get("x", ["label"])[0]
     y_col = settings.get("y", ["value"])[0]
     data[y_col] = data[y_col].astype(float)
-    data[x_col] = data[x_col].apply(do_prefixes)
+    data[x_col] = prefix_column(data[x_col])
     return px.bar(data, x=x_col, y=y_col, title=label)
 
 
@@ -16,34 +19,65 @@ def do_piechart(settings: dict, data: pd.DataFrame, label=None):
     values = settings.get("values", ["value"])[0]
     names = settings.get("names", ["label"])[0]
     data[values] = data[values].astype(float)
-    data[names] = data[names].apply(do_prefixes)
+    data[names] = prefix_column(data[names])
     return px.pie(data, values=values, names=names, title=label)
 
 
+# A line with a WKT POINT, possibly after a CRS IRI, or any other line
+WKT_POINT_LINE = re.compile(
+    r"^(?:[^\n(]*?[Pp][Oo][Ii][Nn][Tt][ \t]*\("
+    r"[ \t]*([-+0-9.eE]+)[ \t]+([-+0-9.eE]+)[^\n]*|[^\n]*)$",
+    re.MULTILINE,
+)
+
+
+def parse_points(column: pd.Series) -> pd.DataFrame:
+    """The lon and lat of a column of WKT POINT(lon lat) literals, NaN if not a point.
+    Instead of parsing every value in Python, the column is joined into one text,
+    a single regex substitution turns every line into "lon lat", or " " if it is not
+    a point, and the pandas CSV parser reads the numbers from that."""
+    if len(column) == 0:
+        return pd.DataFrame({"lon": [], "lat": []}, dtype=float)
+    values = column.where(column.notna(), "").astype(str).tolist()
+    text = "\n".join(values)
+    if text.count("\n") != len(values) - 1:
+        # Literals with newlines in them would throw the lines out of step
+        text = "\n".join(value.replace("\n", " ") for value in values)
+    points = pd.read_csv(
+        io.StringIO(WKT_POINT_LINE.sub(r"\1 \2", text)),
+        sep=" ",
+        header=None,
+        names=["lon", "lat"],
+        skip_blank_lines=False,
+    )
+    points.index = column.index
+    # Nothing to do for columns read as floats, only for values like "1.2.3"
+    return points.apply(pd.to_numeric, errors="coerce")
+
+
+def bin_points(data: pd.DataFrame, zoom: int) -> pd.DataFrame:
+    """Aggregate the points into the web map tiles they fall in, three zoom levels
+    deeper than the one the map is shown at, so that each tile on screen is split
+    into 8x8 bins. Returns a point per bin, at the mean position of its points, with
+    their count."""
+    n = 2 ** (zoom + 3)
+    lat = np.radians(data["lat"].clip(-85.0511, 85.0511))
+    x = ((data["lon"] + 180) / 360 * n).clip(0, n - 1).astype(int)
+    y = ((1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * n).clip(0, n - 1)
+    return (
+        data.groupby([x, y.astype(int)])
+        .agg(lat=("lat", "mean"), lon=("lon", "mean"), count=("lat", "size"))
+        .reset_index(drop=True)
+    )
+
+
 def do_mapchart(settings: dict, data: pd.DataFrame, label=None):
     point = settings.get("point", ["geo"])[0]
 
     if point in data.columns:
-
-        def safe_extract_lat(point):
-            try:
-                return float(point.upper().replace("POINT(", "").split(" ")[0])
-            except Exception:
-                return None
-
-        def safe_extract_lon(point):
-            try:
-                return float(
-                    point.upper().replace("POINT(", "").strip(")").split(" ")[1]
-                )
-            except Exception:
-                return None
-
-        data["lon"] = data[point].apply(safe_extract_lat)
-        data["lat"] = data[point].apply(safe_extract_lon)
-
-        # Remove rows where lat or lon is None
-        data = data.dropna(subset=["lat", "lon"])
+        points = parse_points(data[point])
+        data["lon"] = points["lon"]
+        data["lat"] = points["lat"]
 
     if "lat" not in data.columns or "lon" not in data.columns:
         raise ValueError(
@@ -55,11 +89,19 @@ def do_mapchart(settings: dict, data: pd.DataFrame, label=None):
 
     data[lat_col] = data[lat_col].astype(float)
     data[lon_col] = data[lon_col].astype(float)
+    # Remove rows where lat or lon is None
+    data = data.dropna(subset=[lat_col, lon_col])
 
     center_lat = float(settings.get("lat", [0])[0])
     center_lon = float(settings.get("lon", [0])[0])
 
     zoom = int(settings.get("zoom", [3])[0])
+    options = {}
+    aggregate = settings.get("aggregate", [None])[0]
+    if aggregate == "tiles" or (MAP_MAX_POINTS and len(data) > MAP_MAX_POINTS):
+        # Send a point per bin to the browser, sized by how many points are in it
+        data = bin_points(data, zoom)
+        options = {"size": "count", "hover_data": {"count": True}}
     return px.scatter_map(
         data,
         lat=lat_col,
@@ -67,4 +109,5 @@ def do_mapchart(settings: dict, data: pd.DataFrame, label=None):
         zoom=zoom,
         title=label,
         center={"lat": center_lat, "lon": center_lon},
+        **options,
     )
@@ -25,6 +25,24 @@ log.debug("Trying Redis at " + REDIS_HOST)
 
 redis_client = None
 
+# Cached query results are served as they are for CACHE_SOFT_TTL seconds. After that
+# they are still served, but queries hit at least CACHE_REFRESH_HITS times since they
+# were last cached are re-run in the background. They are dropped after CACHE_TTL.
+CACHE_TTL = int(os.environ.get("CACHE_TTL", str(60 * 60 * 24 * 3)))
+CACHE_SOFT_TTL = int(os.environ.get("CACHE_SOFT_TTL", str(60 * 60 * 24)))
+CACHE_REFRESH_HITS = int(os.environ.get("CACHE_REFRESH_HITS", "2"))
+
+# Serialized query results are stored gzipped in the cache, at this level
+CACHE_COMPRESSION_LEVEL = int(os.environ.get("CACHE_COMPRESSION_LEVEL", "6"))
+
+# Size in MB and expiry in seconds of the in-process cache that sits in front of Redis,
+# and is the only cache if Redis is not available. A size of 0 disables it.
+LOCAL_CACHE_SIZE = int(float(os.environ.get("LOCAL_CACHE_SIZE", "64")) * 1024 * 1024)
+LOCAL_CACHE_TTL = int(os.environ.get("LOCAL_CACHE_TTL", str(60 * 60)))
+
+# How often, in seconds, a worker waiting on another worker's query checks if it is done
+CACHE_LOCK_POLL = float(os.environ.get("CACHE_LOCK_POLL", "0.1"))
+
 
 async def init_redis():
     """Test whether Redis is reachable and, if so, install it as the
@@ -45,6 +63,7 @@ async def init_redis():
         redis_client = None
     return redis_client
 
+
 ENDPOINT = os.environ.get("ENDPOINT")
 
 # ENDPOINTS variable with name|url pairs
@@ -56,6 +75,14 @@ ens_pairs = [pair.split("|") for pair in ens.split(" ") if "|" in pair]
 # Convert into a dictionary
 ENDPOINTS = {name: url for name, url in ens_pairs}
 
+# Connection pool settings for the HTTP clients used to query remote ENDPOINT(S)
+ENDPOINT_TIMEOUT = float(os.environ.get("ENDPOINT_TIMEOUT", "180"))
+ENDPOINT_MAX_CONNECTIONS = int(os.environ.get("ENDPOINT_MAX_CONNECTIONS", "20"))
+ENDPOINT_MAX_KEEPALIVE = int(os.environ.get("ENDPOINT_MAX_KEEPALIVE", "10"))
+ENDPOINT_KEEPALIVE_EXPIRY = float(os.environ.get("ENDPOINT_KEEPALIVE_EXPIRY", "30"))
+# HTTP/2 is only used if the optional h2 package is installed
+ENDPOINT_HTTP2 = os.environ.get("ENDPOINT_HTTP2", "1") == "1"
+
 SCHEME = os.environ.get("SCHEME", "http://")
 DOMAIN = os.environ.get("DOMAIN", "127.0.0.1")
 PORT = os.environ.get("PORT", "5001")
@@ -72,7 +99,86 @@ else:
     DATA_LOAD_PATHS = []
 STORE_PATH = os.environ.get("STORE_PATH")
 
+# Number of files from DATA_LOAD_PATHS that are downloaded and parsed in parallel,
+# and how often, in seconds, the loading progress is logged
+LOAD_WORKERS = int(os.environ.get("LOAD_WORKERS", str(min(4, os.cpu_count() or 1))))
+LOAD_PROGRESS_INTERVAL = float(os.environ.get("LOAD_PROGRESS_INTERVAL", "10"))
+
+# The data version a prebuilt STORE_PATH is expected to have, as reported by the
+# build_store command. A store with a different version is not used.
+STORE_VERSION = os.environ.get("STORE_VERSION")
+
+# A STORE_PATH without DATA_LOAD_PATHS is only served once shmarql marked it as
+# completely loaded. Set this for a store that was built some other way, which
+# never gets that marker, to serve it as it is.
+STORE_EXTERNAL = os.environ.get("STORE_EXTERNAL", "0") == "1"
+
+# How often, in seconds, workers check whether the STORE_PATH has been (re)loaded
+STORE_POLL_INTERVAL = float(os.environ.get("STORE_POLL_INTERVAL", "5"))
+
+# Local store queries run in a thread pool so they do not block the event loop.
+# LOCAL_QUERY_WORKERS queries run concurrently, up to LOCAL_QUERY_QUEUE more may wait
+# for a free worker, anything beyond that is rejected with a 503.
+LOCAL_QUERY_WORKERS = int(
+    os.environ.get("LOCAL_QUERY_WORKERS", str(min(8, os.cpu_count() or 1)))
+)
+LOCAL_QUERY_QUEUE = int(os.environ.get("LOCAL_QUERY_QUEUE", "32"))
+
+# Queries running longer than QUERY_TIMEOUT seconds are stopped, local ones as soon as
+# the worker thread notices, which it does while producing results.
+QUERY_TIMEOUT = float(os.environ.get("QUERY_TIMEOUT", str(ENDPOINT_TIMEOUT)))
+# Results of more than MAX_RESULT_ROWS rows are cut off there in the UI, API results
+# larger than MAX_RESULT_BYTES are refused. 0 for no limit.
+MAX_RESULT_ROWS = int(os.environ.get("MAX_RESULT_ROWS", "0"))
+MAX_RESULT_BYTES = int(os.environ.get("MAX_RESULT_BYTES", "0"))
+
+# Per client limits on queries, a client being an IP address or an API key. Clients
+# get a 429 if they send more than RATE_LIMIT_PER_MINUTE queries a minute, or have
+# more than MAX_CONCURRENT_QUERIES running at once. 0 for no limit. The counts are
+# kept in Redis, without it every worker process counts on its own.
+RATE_LIMIT_PER_MINUTE = int(os.environ.get("RATE_LIMIT_PER_MINUTE", "0"))
+MAX_CONCURRENT_QUERIES = int(os.environ.get("MAX_CONCURRENT_QUERIES", "0"))
+# Behind a reverse proxy every request comes from the proxy, set this to the header it
+# puts the client address in, like X-Forwarded-For
+CLIENT_IP_HEADER = os.environ.get("CLIENT_IP_HEADER")
+# The number of proxies in front of shmarql that append to the CLIENT_IP_HEADER. The
+# client address is the one the outermost of them added, counted from the right, as
+# anything to the left of it was sent by the client and can not be trusted.
+TRUSTED_PROXIES = int(os.environ.get("TRUSTED_PROXIES", "1"))
+# API_KEYS variable with name|key pairs. A request with a known key in the
+# API_KEY_HEADER is counted as that client, wherever it comes from.
+API_KEY_HEADER = os.environ.get("API_KEY_HEADER", "X-API-Key")
+api_key_pairs = [
+    pair.split("|", 1)
+    for pair in os.environ.get("API_KEYS", "").split(" ")
+    if "|" in pair
+]
+API_KEYS = {key: name for name, key in api_key_pairs}
+
+# Serve Prometheus metrics at /metrics, off by default as anyone can read them
+# there, so only set it where /metrics is not reachable from outside. With Redis,
+# every worker process publishes its metrics each METRICS_PUBLISH_INTERVAL seconds,
+# and /metrics reports the totals of all of them. Otherwise it only reports the
+# worker that answers.
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "0") == "1"
+METRICS_PUBLISH_INTERVAL = float(os.environ.get("METRICS_PUBLISH_INTERVAL", "15"))
+
+# Stream json/xml/csv/tsv results from the local store to the client while they
+# are being computed, instead of building the whole result in memory first.
+# Streamed results are not cached.
+STREAM_RESULTS = os.environ.get("STREAM_RESULTS", "0") == "1"
+STREAM_CHUNK_SIZE = int(os.environ.get("STREAM_CHUNK_SIZE", str(64 * 1024)))
+STREAM_BUFFER_CHUNKS = int(os.environ.get("STREAM_BUFFER_CHUNKS", "16"))
+
+# Map charts with more points than this are binned into tiles on the server, as if
+# the query had "# shmarql-aggregate: tiles". 0, the default, to never do so.
+MAP_MAX_POINTS = int(os.environ.get("MAP_MAX_POINTS", "0"))
+
 BIKIDATA_DB = os.environ.get("BIKIDATA_DB")
+# Only index the triples with a literal object, which is all that fizzy:fts needs. The
+# /bikidata browser also uses the links between entities, so this is off by default.
+BIKIDATA_LITERALS_ONLY = os.environ.get("BIKIDATA_LITERALS_ONLY", "0") == "1"
+BIKIDATA_WORKERS = int(os.environ.get("BIKIDATA_WORKERS", str(os.cpu_count() or 1)))
 SEMANTIC_INDEX = os.environ.get("SEMANTIC_INDEX", "0") == "1"
 RDF2VEC_INDEX = os.environ.get("RDF2VEC_INDEX", "0") == "1"
 
@@ -92,12 +198,24 @@ if RDF2VEC_FILEPATH:
 
 
 SPARQL_QUERY_UI = os.environ.get("SPARQL_QUERY_UI", "1") == "1"
+# Result tables in the UI show this many rows at a time, further pages are served
+# from the cached result
+TABLE_PAGE_SIZE = int(os.environ.get("TABLE_PAGE_SIZE", "500"))
 
 SITE_ID = os.environ.get(
     "SITE_ID", "".join([random.choice("abcdef0123456789") for _ in range(10)])
 )
+# The Redis hash that the worker processes of this site publish their metrics in.
+# SITE_ID above is random for every process if not set, then the SITE_URI is used.
+METRICS_KEY = "metrics:" + os.environ.get("SITE_ID", SITE_URI)
 
 SITEDOCS_PATH = os.environ.get("SITEDOCS_PATH", os.path.join(os.getcwd(), "site"))
+# How long browsers may use site and static files without asking again, files with a
+# content hash in their name are cached for a year
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", "300"))
+# Site and static files are taken to stay as they were at startup, like in a built
+# image. Set this when working on a site, to check them for changes on every request.
+STATIC_RELOAD = os.environ.get("STATIC_RELOAD", "1" if DEBUG else "0") == "1"
 
 PREFIXES_FILEPATH = os.environ.get("PREFIXES_FILEPATH")
 DEFAULT_PREFIXES = {
@@ -1,20 +1,22 @@
 from urllib.parse import quote
-import random, json
+from typing import Annotated
+from html import escape
+import json, time
 
 from fastcore.xml import *
 from fastcore.basics import NotStr
-from .config import MOUNT, PREFIXES_SNIPPET
+from .config import MOUNT, PREFIXES_SNIPPET, TABLE_PAGE_SIZE
 from uuid import uuid4
 
-from plotly.io import to_json
-from .px_util import results_to_df, do_prefixes
+from .px_util import results_to_df, do_prefixes, prefix_resolver
 import traceback
-from .charts import do_barchart, do_piechart, do_mapchart
+from fastapi import Form as FormField  # fastcore.xml has a Form tag too
 from .render import APIRouter
 
 rt = APIRouter()
 
 from .qry import do_query
+from .metrics import METRICS
 
 BTN_STYLE = "bg-slate-300 hover:bg-slate-400 text-black px-2 rounded-lg shadow-xl transition duration-300 font-bold"
 
@@ -116,7 +118,12 @@ def make_spo(uri: str, spo: str, encode=True, limit=999, extra=""):
 
 @rt.post(f"/shmarql/fragments/sparql")
 @rt.post(f"{MOUNT}shmarql/fragments/sparql")
-async def fragments_sparql(query: str, prev_query: str = "", results=None):
+async def fragments_sparql(
+    query: Annotated[str, FormField()],
+    prev_query: Annotated[str, FormField()] = "",
+    results=None,
+    page: Annotated[int, FormField()] = 1,
+):
     if query == "":
         query = "select * where {?s ?p ?o} limit 10"
     if results is None:
@@ -140,106 +147,139 @@ async def fragments_sparql(query: str, prev_query: str = "", results=None):
             ),
         )
 
+    start = time.time()
     if "resource" in settings.get("view", []):
-        return await fragments_resource(results, query, prev_query)
-    if settings.get("view", [""])[0].endswith("chart"):
-        return await fragments_chart(query)
+        view, fragment = "resource", await fragments_resource(
+            results, query, prev_query
+        )
+    elif settings.get("view", [""])[0].endswith("chart"):
+        view, fragment = "chart", await fragments_chart(query, results=results)
     else:
-        return build_plain_table(query, prev_query, results)
-
-
-def build_plain_table(query: str, prev_query: str, results: dict):
-    table_rows = []
-    heads = [Th("#", style="color: #aaa; text-align: right;")]
-    heads.extend(
-        [
-            Th(var, style="font-weight: bold")
-            for var in results.get("head", {}).get("vars", [])
-        ]
+        view, fragment = "table", build_plain_table(query, prev_query, results, page)
+    METRICS.observe("shmarql_render_duration_seconds", time.time() - start, view=view)
+    return fragment
+
+
+# The S/P/O links of a URI cell only carry the IRI, the script builds the query to
+# run from the templates on the table when one is clicked, before the click handler
+# of the page (shmarql.js) reads it from data-shmarqlspo. It also swaps in the other
+# pages of the table, posting the query to the fragment like the query form does.
+TABLE_STYLE = """<style>
+.shmarql-rownum { color: #aaa; text-align: right; }
+.shmarql-spo { font-size: 80%; display: inline-block; margin-left: 0.5em; }
+.shmarql-spo a {
+  font-size: 70%; background-color: #ddd; color: #000;
+  padding: 3px; text-decoration: none; margin: 0;
+}
+.shmarql-bnode { font-size: 80%; font-style: italic; }
+.shmarql-lang { font-size: 80%; vertical-align: super; }
+</style>"""
+TABLE_SCRIPT = """<script>
+if (!window.shmarqlSpoTemplates) {
+  window.shmarqlSpoTemplates = true;
+  document.addEventListener("click", function (event) {
+    const link = event.target.closest(".shmarql_spo_link[data-spo]");
+    if (!link || link.dataset.shmarqlspo) return;
+    const table = link.closest("[data-shmarqltemplates]");
+    const templates = JSON.parse(table.dataset.shmarqltemplates);
+    const iri = encodeURIComponent(link.closest("[data-iri]").dataset.iri);
+    link.dataset.shmarqlspo = templates[link.dataset.spo].replaceAll("__IRI__", iri);
+    link.dataset.shmarqlprevq = table.dataset.shmarqlprevq;
+  }, true);
+  document.addEventListener("click", function (event) {
+    const link = event.target.closest(".shmarql_page_link");
+    if (!link) return;
+    event.preventDefault();
+    const pager = link.closest("[data-action]");
+    const body = new URLSearchParams({
+      query: pager.dataset.query,
+      prev_query: pager.dataset.prevquery,
+      page: link.dataset.page,
+    });
+    fetch(pager.dataset.action, {
+      method: "POST",
+      headers: { "Content-Type": "application/x-www-form-urlencoded" },
+      body: body,
+    })
+      .then((response) => response.text())
+      .then((html) => { link.closest("[shmarql-fragment-type]").outerHTML = html; });
+  });
+}
+</script>"""
+IRI_PLACEHOLDER = "__IRI__"
+
+
+def table_templates() -> str:
+    "The queries behind the links of a URI cell, with a placeholder for the IRI."
+    return json.dumps(
+        {
+            "r": make_resource_query(IRI_PLACEHOLDER),
+            "s": make_spo(IRI_PLACEHOLDER, "s"),
+            "p": make_spo(IRI_PLACEHOLDER, "p"),
+            "o": make_spo(IRI_PLACEHOLDER, "o"),
+        }
     )
-    rownum = 0
-    for row in results.get("results", {}).get("bindings", []):
-        rownum += 1
-        row_columns = []
-        row_columns.append(
-            Td(
-                rownum,
-                style="color: #aaa; text-align: right;",
-            )
-        )
-        for var in results.get("head", {}).get("vars", []):
-            value = row.get(var, {"value": ""})
-            if value.get("type") == "uri":
-                S_query = make_spo(value["value"], "s")
-                P_query = make_spo(value["value"], "p")
-                O_query = make_spo(value["value"], "o")
 
-                nonce = random.randint(0, pow(2, 32))
-
-                if var in ("s", "p", "o"):
-                    var_spo = var
-                else:
-                    var_spo = "s"
 
-                row_columns.append(
-                    Td(
-                        A(
-                            do_prefixes(value["value"], results.get("prefixes", {})),
-                            data_shmarqlspo=make_resource_query(value["value"]),
-                            data_shmarqlprevq=query,
-                            cls="shmarql_spo_link",
-                            href="#",
-                        ),
-                        Div(
-                            A(
-                                "S",
-                                data_shmarqlspo=S_query,
-                                data_shmarqlprevq=query,
-                                cls="shmarql_spo_link",
-                                href="#",
-                                style="font-size: 70%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                            ),
-                            A(
-                                "P",
-                                data_shmarqlspo=P_query,
-                                data_shmarqlprevq=query,
-                                cls="shmarql_spo_link",
-                                href="#",
-                                style="font-size: 70%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                            ),
-                            A(
-                                "O",
-                                data_shmarqlspo=O_query,
-                                data_shmarqlprevq=query,
-                                cls="shmarql_spo_link",
-                                href="#",
-                                style="font-size: 70%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                            ),
-                            style="font-size: 80%; display: inline-block; margin-left: 0.5em;",
-                        ),
-                    )
+def render_table_rows(
+    vars: list, bindings: list, prefixes: dict, offset: int = 0
+) -> str:
+    """The <tr>s of a results table, written straight into a string instead of
+    building a Tr/Td/A tree for every cell, numbered from offset + 1."""
+    resolver = prefix_resolver(prefixes)
+    buf = []
+    for rownum, row in enumerate(bindings, offset + 1):
+        buf.append(f'<tr><td class="shmarql-rownum">{rownum}</td>')
+        for var in vars:
+            value = row.get(var)
+            if value is None:
+                buf.append("<td></td>")
+            elif value.get("type") == "uri":
+                iri = value["value"]
+                label = escape(resolver.compact(iri))
+                buf.append(
+                    f'<td data-iri="{escape(iri)}">'
+                    f'<a class="shmarql_spo_link" data-spo="r" href="#">{label}</a>'
+                    '<span class="shmarql-spo">'
+                    '<a class="shmarql_spo_link" data-spo="s" href="#">S</a>'
+                    '<a class="shmarql_spo_link" data-spo="p" href="#">P</a>'
+                    '<a class="shmarql_spo_link" data-spo="o" href="#">O</a>'
+                    "</span></td>"
                 )
             elif value.get("type") == "bnode":
-                row_columns.append(
-                    Td(
-                        Span(
-                            value["value"], style="font-size: 80%; font-style: italic"
-                        ),
-                    )
+                buf.append(
+                    '<td><span class="shmarql-bnode">'
+                    f'{escape(value["value"])}</span></td>'
                 )
-            else:
-                lang = (
-                    Span(
-                        value.get("xml:lang"),
-                        style="font-size: 80%; vertical-align: super;",
-                    )
-                    if "xml:lang" in value
-                    else None
+            elif "xml:lang" in value:
+                buf.append(
+                    f'<td><span>{escape(value["value"])}</span>'
+                    '<span class="shmarql-lang">'
+                    f'{escape(value["xml:lang"])}</span></td>'
                 )
+            else:
+                buf.append(f'<td><span>{escape(value["value"])}</span></td>')
+        buf.append("</tr>")
+    return "".join(buf)
+
+
+def page_link(page: int, label: str):
+    return A(
+        label,
+        href="#",
+        data_page=page,
+        cls="shmarql_page_link",
+        style="margin-left: 1ch;",
+    )
 
-                row_columns.append(Td(Span(value["value"]), lang))
-        table_rows.append(Tr(*row_columns))
+
+def build_plain_table(query: str, prev_query: str, results: dict, page: int = 1):
+    vars = results.get("head", {}).get("vars", [])
+    bindings = results.get("results", {}).get("bindings", [])
+    heads = [Th("#", cls="shmarql-rownum")]
+    heads.extend([Th(var, style="font-weight: bold") for var in vars])
     cached = " (from cache) " if results.get("cached") else ""
+    truncated = " (cut off at MAX_RESULT_ROWS)" if results.get("truncated") else ""
 
     duration_display = (
         f"{int(results.get('duration', 0) * 1000)}ms"
@@ -247,9 +287,28 @@ def build_plain_table(query: str, prev_query: str, results: dict):
         else f"{results.get('duration', 0):.3f}s"
     )
 
+    # Only one page of the rows is rendered, the others are fetched from the cached
+    # result when asked for
+    pages = max(1, -(-len(bindings) // TABLE_PAGE_SIZE))
+    page = min(max(1, page), pages)
+    offset = (page - 1) * TABLE_PAGE_SIZE
+    rows = bindings[offset : offset + TABLE_PAGE_SIZE]
+    pager = None
+    if pages > 1:
+        pager = Span(
+            f", showing {offset + 1} - {offset + len(rows)}",
+            page_link(page - 1, "◀ previous") if page > 1 else None,
+            page_link(page + 1, "next ▶") if page < pages else None,
+            data_action=f"{MOUNT}shmarql/fragments/sparql",
+            data_query=query,
+            data_prevquery=prev_query,
+        )
+
     return Div(
+        NotStr(TABLE_STYLE + TABLE_SCRIPT),
         P(
-            f"{len(results.get('results', {}).get('bindings', []))} results in {duration_display}{cached}",
+            f"{len(bindings)} results{truncated} in {duration_display}{cached}",
+            pager,
             (
                 (
                     A(
@@ -267,7 +326,15 @@ def build_plain_table(query: str, prev_query: str, results: dict):
             style="font-size: 50%;",
             title="used: " + results.get("endpoint_name", ""),
         ),
-        Table(Thead(Tr(*heads)), Tbody(*table_rows), data_tipe="sparql-results"),
+        Table(
+            Thead(Tr(*heads)),
+            Tbody(
+                NotStr(render_table_rows(vars, rows, results.get("prefixes"), offset))
+            ),
+            data_tipe="sparql-results",
+            data_shmarqltemplates=table_templates(),
+            data_shmarqlprevq=query,
+        ),
         shmarql_fragment_type="table",
     )
 
@@ -430,149 +497,15 @@ async def fragments_resource(results: dict, query: str, prev_query: str = ""):
     return Div(*buf)
 
 
-def build_standalone_table(results, query):
-    table_rows = []
-    heads = [Th(" ")]
-    heads.extend(
-        [
-            Th(var, style="font-weight: bold")
-            for var in results.get("head", {}).get("vars", [])
-        ]
-    )
-    table_rows.append(Tr(*heads))
-
-    rownum = 0
-    for row in results.get("results", {}).get("bindings", []):
-        rownum += 1
-        row_columns = []
-        row_columns.append(
-            Td(
-                rownum,
-                style="padding-right: 0.75ch; color: #aaa; text-align: right;",
-            )
-        )
-        for var in results.get("head", {}).get("vars", []):
-            value = row.get(var, {"value": ""})
-            if value.get("type") == "uri":
-                S_query = make_spo(value["value"], "s")
-                P_query = make_spo(value["value"], "p")
-                O_query = make_spo(value["value"], "o")
-
-                # do some fizzy for factgrid
-                if value["value"].find("database.factgrid.de") > -1:
-                    fizzy_query = quote(
-                        f"""select distinct ?s (STR(?o) AS ?oLabel) where {{
-  ?s fizzy:rdf2vec <{value['value']}> . 
-  ?s rdfs:label ?o .
-}}
-    """
-                    )
-                    fizzyquery = A(
-                        "✨",
-                        href="?query=" + fizzy_query,
-                        title="Show items similar to this entity using fizzysearch",
-                    )
-                else:
-                    fizzyquery = None
-
-                row_columns.append(
-                    Td(
-                        A(
-                            "S",
-                            href=f"{MOUNT}shmarql/?query={S_query}",
-                            style="font-size: 80%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                        ),
-                        A(
-                            "P",
-                            href=f"{MOUNT}shmarql/?query={P_query}",
-                            style="font-size: 80%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                        ),
-                        A(
-                            "O",
-                            href=f"{MOUNT}shmarql/?query={O_query}",
-                            style="font-size: 80%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                        ),
-                        A(
-                            value["value"],
-                            href=value["value"],
-                            style="margin-left: 1ch",
-                        ),
-                        fizzyquery,
-                        cls="border border-gray-300 px-4 py-2 text-sm",
-                    )
-                )
-            elif value.get("type") == "bnode":
-                row_columns.append(
-                    Td(
-                        Span(
-                            value["value"], style="font-size: 80%; font-style: italic"
-                        ),
-                        cls="border border-gray-300 px-4 py-2 text-sm",
-                    )
-                )
-            else:
-                o_link = A(
-                    "O",
-                    href=f"{MOUNT}shmarql/?query={make_literal_query(value)}",
-                    style="font-size: 80%; background-color: #ddd; color: #000; padding: 3px; text-decoration: none; margin: 0",
-                )
-                lang = (
-                    Span(
-                        value.get("xml:lang"), cls="text-xs bg-gray-200 text-black px-2"
-                    )
-                    if "xml:lang" in value
-                    else None
-                )
-
-                row_columns.append(
-                    Td(
-                        o_link,
-                        Span(value["value"], style="margin-left: 1ch"),
-                        lang,
-                        cls="border border-gray-300 px-4 py-2 text-sm",
-                    )
-                )
-        table_rows.append(Tr(*row_columns, cls="hover:bg-gray-50"))
-    cached = " (from cache) " if results.get("cached") else ""
-
-    duration_display = (
-        f"{int(results.get('duration', 0) * 1000)}ms"
-        if results.get("duration", 0) < 1
-        else f"{results.get('duration', 0):.3f}s"
-    )
-
-    return Div(
-        Div(
-            Span(
-                f"{len(results.get('results', {}).get('bindings', []))} results in {duration_display}{cached}",
-                title="used: " + results.get("endpoint_name", ""),
-            ),
-            A(
-                "CSV",
-                title="Download as CSV",
-                href=f"{MOUNT}shmarql/?query={quote(query)}&format=csv",
-                cls=BTN_STYLE,
-            ),
-            A(
-                "JSON",
-                title="Download as JSON",
-                href=f"{MOUNT}shmarql/?query={quote(query)}&format=json",
-                cls=BTN_STYLE,
-            ),
-            cls="bg-slate-200 text-black p-2 flex flex-row gap-1 text-xs",
-        ),
-        Table(
-            *table_rows,
-            cls="min-w-full table-auto border-collapse border border-gray-300",
-        ),
-    )
-
-
 @rt.get(f"{MOUNT}shmarql/fragments/chart")
 async def fragments_chart(query: str, results=None):
     if results is None:
         results = await do_query(query)
 
+    # Charts need pandas and plotly, only imported once the first one is drawn
+    from plotly.io import to_json
+    from .charts import do_barchart, do_piechart, do_mapchart
+
     settings = results.get("shmarql_settings", {})
     chart_type = settings.get("view")[0]
 
@@ -625,7 +558,7 @@ async def build_sparql_ui(query, results):
         results_fragment = await fragments_resource(results, query)
     if settings.get("view", [""])[0].endswith("chart"):
         try:
-            chart_fragment = await fragments_chart(query)
+            chart_fragment = await fragments_chart(query, results=results)
         except Exception as e:
             chart_fragment = Div(
                 f"Error: {e}",
@@ -633,7 +566,9 @@ async def build_sparql_ui(query, results):
             )
         results_fragment = Div(chart_fragment, cls="md-typeset")
     else:
-        results_fragment = Div(fragments_sparql(query, results), cls="md-typeset")
+        results_fragment = Div(
+            await fragments_sparql(query, results=results), cls="md-typeset"
+        )
 
     return (
         Script(src=f"{MOUNT}static/editor.js"),
@@ -0,0 +1,283 @@
+import fcntl, hashlib, json, os, shutil, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+import pyoxigraph as px
+from .config import BIKIDATA_DB, BIKIDATA_LITERALS_ONLY, BIKIDATA_WORKERS, log
+
+# The same tables that bikidata builds, plus the graphs that are in them
+DB_SCHEMA = """
+create table if not exists literals (hash ubigint, value varchar);
+create table if not exists iris (hash ubigint, value varchar);
+create table if not exists triples (s ubigint, p ubigint, o ubigint, g ubigint);
+create table if not exists shmarql_graphs (g varchar, signature varchar);
+"""
+
+
+def H(value: str) -> str:
+    "The hash bikidata uses for terms, of their UTF-8 encoding"
+    # Like duckdb, only needed for the full text index, so only imported to build one
+    import xxhash
+
+    return xxhash.xxh64_hexdigest(value.encode("utf8")).upper()
+
+
+def graph_signatures(store: px.Store, manifest: dict = None) -> dict:
+    """The graphs in store, with a signature that changes when their contents do,
+    taken from the load manifest. All graphs share the signature of all the sources,
+    the triples of a source are not kept apart from the others in the default graph.
+    Without a manifest the signature is None, meaning unknown."""
+    signature = None
+    if manifest:
+        entries = manifest["sources"]
+        signature = hashlib.md5()
+        for source in sorted(entries):
+            signature.update(entries[source].get("hash", "").encode("utf8"))
+        signature = signature.hexdigest()
+    graphs = {px.DefaultGraph(): signature}
+    for graph in store.named_graphs():
+        graphs[graph] = signature
+    return graphs
+
+
+def export_graph(store: px.Store, graph, path: str, literals_only: bool):
+    "Write a graph as N-Triples, natively in pyoxigraph, terms as bikidata hashes them."
+    if literals_only:
+        store.query(
+            "CONSTRUCT { ?s ?p ?o } WHERE { ?s ?p ?o FILTER(isLiteral(?o)) }",
+            default_graph=graph,
+        ).serialize(path, px.RdfFormat.N_TRIPLES)
+    else:
+        store.dump(path, px.RdfFormat.N_TRIPLES, from_graph=graph)
+
+
+def hash_ntriples(path: str, g: str):
+    """Turn an N-Triples file of graph g into the tab separated triple hashes and
+    hash to value maps that are bulk loaded into the index."""
+    import xxhash
+
+    # H, without an import statement for every term
+    digest = xxhash.xxh64_hexdigest
+    gg = H(g)
+    seen = set()
+    with (
+        open(path, encoding="utf8") as f,
+        open(path + ".triples", "w", encoding="utf8") as triples,
+        open(path + ".maps", "w", encoding="utf8") as maps,
+    ):
+        if g != str(px.DefaultGraph()):
+            maps.write(f"{gg}\t|\t{g}\n")
+        for line in f:
+            s, p, o = line[:-3].split(" ", 2)
+            ss = digest(s.encode("utf8")).upper()
+            pp = digest(p.encode("utf8")).upper()
+            oo = digest(o.encode("utf8")).upper()
+            triples.write(f"{ss}\t{pp}\t{oo}\t{gg}\n")
+            if pp not in seen:
+                # There are few distinct predicates, no need to repeat them
+                seen.add(pp)
+                maps.write(f"{pp}\t|\t{p}\n")
+            maps.write(f"{ss}\t|\t{s}\n{oo}\t|\t{o}\n")
+    os.remove(path)
+
+
+def build_index(
+    store: px.Store,
+    graphs: dict,
+    db_path: str = BIKIDATA_DB,
+    literals_only: bool = BIKIDATA_LITERALS_ONLY,
+    workers: int = BIKIDATA_WORKERS,
+) -> dict:
+    """Bring the bikidata index at db_path up to date with the graphs in store, as
+    returned by graph_signatures. Only graphs that are new, or whose signature
+    changed, are (re)indexed, and the ones no longer in the store removed."""
+    import duckdb
+
+    start_time = time.time()
+    mode = "literals" if literals_only else "all"
+    graphs = {
+        str(graph): (graph, f"{signature}|{mode}")
+        for graph, signature in graphs.items()
+    }
+
+    db = duckdb.connect(db_path)
+    try:
+        db.execute(DB_SCHEMA)
+        indexed = dict(db.execute("select g, signature from shmarql_graphs").fetchall())
+        if not indexed and db.execute("select count(*) from triples").fetchone()[0] > 0:
+            log.info(
+                f"Index {db_path} was built by bikidata, indexing all graphs again"
+            )
+
+        def stale(g: str, signature: str) -> bool:
+            if g not in indexed:
+                return True
+            if signature.startswith("None|"):
+                # Unknown, only index it again if it was indexed in another mode
+                return not indexed[g].endswith(f"|{mode}")
+            return indexed[g] != signature
+
+        to_index = [g for g, (_, signature) in graphs.items() if stale(g, signature)]
+        removed = [g for g in indexed if g not in graphs]
+        if not (to_index or removed):
+            log.debug(f"Index {db_path} is up to date")
+            return {"duration": 0, "graphs": 0}
+
+        # In one transaction, so that an update that fails is done again on the next
+        # start
+        db.begin()
+        for g in to_index + removed:
+            db.execute("delete from triples where g = ?::ubigint", (f"0x{H(g)}",))
+            db.execute("delete from shmarql_graphs where g = ?", (g,))
+        if indexed:
+            db.execute("delete from literals where hash not in (select o from triples)")
+            db.execute("""delete from iris where hash not in (
+                    select s from triples union select p from triples
+                    union select o from triples union select g from triples
+                )""")
+
+        def prepare(g: str, path: str):
+            export_graph(store, graphs[g][0], path, literals_only)
+            hash_ntriples(path, g)
+
+        tmpdir = tempfile.mkdtemp(prefix="shmarql-fts-")
+        try:
+            paths = [os.path.join(tmpdir, f"{i}.nt") for i in range(len(to_index))]
+            # pyoxigraph releases the GIL while exporting, so graphs export in
+            # parallel. Hashing is pure Python and holds it, but runs in these threads
+            # too: forking processes from a threaded server can deadlock, and spawned
+            # ones would import shmarql, and load the store, all over again.
+            with ThreadPoolExecutor(workers) as executor:
+                list(executor.map(prepare, to_index, paths))
+
+            # Graphs without any (literal) triples leave an empty file, which read_csv
+            # can not make sense of
+            triple_files, map_files = [
+                [path + ext for path in paths if os.path.getsize(path + ext) > 0]
+                for ext in (".triples", ".maps")
+            ]
+            if triple_files:
+                db.execute(f"""insert into triples select
+                        ('0x' || s).lower()::ubigint, ('0x' || p).lower()::ubigint,
+                        ('0x' || o).lower()::ubigint, ('0x' || g).lower()::ubigint
+                    from read_csv({triple_files}, delim='\t', header=false, quote='',
+                        columns={{'s': 'varchar', 'p': 'varchar', 'o': 'varchar',
+                        'g': 'varchar'}})""")
+            if map_files:
+                db.execute(f"""create temporary table new_maps as select
+                        ('0x' || h).lower()::ubigint as hash, ANY_VALUE(v) as value
+                    from read_csv({map_files}, delim='\t|\t', header=false,
+                        max_line_size=5100000, quote='',
+                        columns={{'h': 'varchar', 'v': 'varchar'}})
+                    group by h""")
+                db.execute("""insert into literals select hash, value from new_maps
+                    where substr(value, 1, 1) = '"'
+                    and hash not in (select hash from literals) order by hash""")
+                db.execute("""insert into iris select hash, value from new_maps
+                    where substr(value, 1, 1) != '"'
+                    and hash not in (select hash from iris) order by hash""")
+                db.execute("drop table new_maps")
+        finally:
+            shutil.rmtree(tmpdir)
+
+        if to_index:
+            db.executemany(
+                "insert into shmarql_graphs values (?, ?)",
+                [(g, graphs[g][1]) for g in to_index],
+            )
+
+        # Same as bikidata, allowing the FTS settings to be overridden
+        fts_settings = os.environ.get(
+            "BIKIDATA_FTS_SETTINGS",
+            "ignore = '[^a-zA-Z0-9]+', strip_accents = 1, lower=1, stemmer='porter'",
+        )
+        db.execute(
+            "pragma create_fts_index('literals', 'hash', 'value',"
+            f" {fts_settings}, overwrite=1)"
+        )
+        db.commit()
+        duration = int(time.time() - start_time)
+        log.info(
+            f"Index {db_path} updated in {duration} seconds, {len(to_index)} graphs"
+            f" indexed and {len(removed)} removed"
+        )
+        return {"duration": duration, "graphs": len(to_index)}
+    finally:
+        db.close()
+
+
+def lock_index(db_path: str, exclusive: bool = True, wait: bool = False):
+    lock_file = open(db_path + ".lock", "a")
+    try:
+        fcntl.flock(
+            lock_file,
+            (fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            | (0 if wait else fcntl.LOCK_NB),
+        )
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def read_failed(db_path: str) -> dict:
+    """The marker left by the last update of the index at db_path if it failed,
+    with the error, or None."""
+    try:
+        with open(db_path + ".failed") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def fts_state() -> str:
+    """The state of the full-text index, for this or any other process: warming
+    while it is being built, failed if the last update did not work out, otherwise
+    ready. None if there is no index."""
+    if not BIKIDATA_DB:
+        return None
+    lock = lock_index(BIKIDATA_DB, exclusive=False)
+    if lock is None:
+        return "warming"
+    lock.close()
+    return "failed" if read_failed(BIKIDATA_DB) else "ready"
+
+
+def update_index(
+    store: px.Store, graphs: dict, db_path: str = BIKIDATA_DB, wait: bool = False
+) -> bool:
+    """Update the index while holding its lock, in which case fts_state() is
+    warming. If another thread or process is already doing so, wait for it to
+    finish first, or do nothing. Returns whether the index was brought up to date
+    here."""
+    lock = lock_index(db_path, wait=wait)
+    if lock is None:
+        log.debug(f"Index {db_path} is being updated by another process")
+        return False
+    try:
+        build_index(store, graphs, db_path)
+    except Exception as e:
+        log.exception(f"Problem updating index {db_path}")
+        with open(db_path + ".failed", "w") as f:
+            json.dump({"error": str(e), "at": time.time()}, f)
+        return False
+    else:
+        if os.path.exists(db_path + ".failed"):
+            os.remove(db_path + ".failed")
+        return True
+    finally:
+        lock.close()
+
+
+def start_index_update(store: px.Store, manifest: dict = None):
+    "Update the index in the background, so that startup does not wait for it."
+    if not BIKIDATA_DB:
+        return
+    global INDEX_UPDATE
+    graphs = graph_signatures(store, manifest)
+    INDEX_UPDATE = threading.Thread(
+        target=update_index, args=(store, graphs), daemon=True
+    )
+    INDEX_UPDATE.start()
+
+
+# The background update started by start_index_update, if any
+INDEX_UPDATE = None
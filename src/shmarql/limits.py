@@ -0,0 +1,118 @@
+import time
+from fastapi import Request
+from . import config
+from .config import (
+    RATE_LIMIT_PER_MINUTE,
+    MAX_CONCURRENT_QUERIES,
+    QUERY_TIMEOUT,
+    CLIENT_IP_HEADER,
+    TRUSTED_PROXIES,
+    API_KEY_HEADER,
+    API_KEYS,
+    log,
+)
+from .metrics import METRICS
+
+
+def client_id(request: Request) -> str:
+    "Who a request is counted against, the name of its API key or its IP address."
+    key = request.headers.get(API_KEY_HEADER)
+    if key and key in API_KEYS:
+        return f"key:{API_KEYS[key]}"
+    if CLIENT_IP_HEADER and request.headers.get(CLIENT_IP_HEADER):
+        # Every proxy appends the address it got the request from, the ones to the
+        # left of what our outermost proxy added are made up by whoever sent it
+        addresses = request.headers[CLIENT_IP_HEADER].split(",")
+        return f"ip:{addresses[max(0, len(addresses) - TRUSTED_PROXIES)].strip()}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
+
+
+def too_many(error: str, retry_after: int) -> dict:
+    return {"error": error, "status": 429, "retry_after": max(1, retry_after)}
+
+
+class Limiter:
+    """Counts the queries of every client, in the current minute and running right
+    now. In Redis if it is available, so that the limits hold across all workers,
+    otherwise in this process."""
+
+    def __init__(self):
+        self.minutes = {}
+        self.running = {}
+
+    async def admit(self, client: str) -> tuple:
+        """Count a query for client. Returns None if it may go ahead, or the error
+        to send if it is over its limits, and where the query was counted, redis,
+        local or None. Every admitted query must be released with the latter."""
+        if not (RATE_LIMIT_PER_MINUTE or MAX_CONCURRENT_QUERIES):
+            return None, None
+        minute = int(time.time() // 60)
+        retry_after = 60 - int(time.time() % 60)
+        counted = "local"
+        if config.redis_client:
+            try:
+                queries, running = await self.count_redis(client, minute)
+                counted = "redis"
+            except Exception as e:
+                log.warning(f"Counting queries in Redis failed, counting locally: {e}")
+        if counted == "local":
+            queries, running = self.count_local(client, minute)
+        if RATE_LIMIT_PER_MINUTE and queries > RATE_LIMIT_PER_MINUTE:
+            await self.release(client, counted)
+            log.debug(f"Rejecting query of {client}, {queries} this minute")
+            METRICS.inc("shmarql_rejected_queries_total", reason="rate")
+            return (
+                too_many(
+                    f"More than {RATE_LIMIT_PER_MINUTE} queries a minute, try again"
+                    " later",
+                    retry_after,
+                ),
+                None,
+            )
+        if MAX_CONCURRENT_QUERIES and running > MAX_CONCURRENT_QUERIES:
+            await self.release(client, counted)
+            log.debug(f"Rejecting query of {client}, {running - 1} already running")
+            METRICS.inc("shmarql_rejected_queries_total", reason="concurrency")
+            return (
+                too_many(
+                    f"More than {MAX_CONCURRENT_QUERIES} queries running at once, wait"
+                    " for them to finish",
+                    1,
+                ),
+                None,
+            )
+        return None, counted
+
+    async def release(self, client: str, counted: str):
+        "The query admitted for client is done, counted where admit said it was."
+        if counted == "local":
+            self.running[client] -= 1
+            if self.running[client] < 1:
+                del self.running[client]
+        elif counted == "redis":
+            try:
+                await config.redis_client.decr(f"running:{client}")
+            except Exception as e:
+                log.warning(f"Releasing query in Redis failed: {e}")
+
+    def count_local(self, client: str, minute: int) -> tuple:
+        if len(self.minutes) > 10000:
+            self.minutes = {k: v for k, v in self.minutes.items() if v[0] == minute}
+        m, n = self.minutes.get(client, (minute, 0))
+        n = n + 1 if m == minute else 1
+        self.minutes[client] = (minute, n)
+        self.running[client] = self.running.get(client, 0) + 1
+        return n, self.running[client]
+
+    async def count_redis(self, client: str, minute: int) -> tuple:
+        async with config.redis_client.pipeline(transaction=False) as pipe:
+            pipe.incr(f"rate:{client}:{minute}")
+            pipe.expire(f"rate:{client}:{minute}", 60)
+            pipe.incr(f"running:{client}")
+            # So that the count of a worker that died with queries running recovers
+            pipe.expire(f"running:{client}", int(QUERY_TIMEOUT) + 60)
+            queries, _, running, _ = await pipe.execute()
+        return queries, running
+
+
+LIMITER = Limiter()
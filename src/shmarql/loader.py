@@ -0,0 +1,347 @@
+import fcntl, gzip, hashlib, json, os, tempfile, threading, time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import httpx
+import pyoxigraph as px
+from .config import LOAD_WORKERS, LOAD_PROGRESS_INTERVAL, log
+from .metrics import METRICS
+
+RDF_FORMATS = {
+    "ttl": px.RdfFormat.TURTLE,
+    "turtle": px.RdfFormat.TURTLE,
+    "nt": px.RdfFormat.N_TRIPLES,
+    "nq": px.RdfFormat.N_QUADS,
+    "trig": px.RdfFormat.TRIG,
+    "n3": px.RdfFormat.N3,
+    "rdf": px.RdfFormat.RDF_XML,
+    "xml": px.RdfFormat.RDF_XML,
+    "owl": px.RdfFormat.RDF_XML,
+}
+
+
+def is_remote(source: str) -> bool:
+    return source.startswith("http://") or source.startswith("https://")
+
+
+def rdf_format(name: str, default: px.RdfFormat = None) -> tuple:
+    """Guess the RDF format of a file from its name, for local files and URLs alike.
+    Returns a (format, gzipped) tuple, format is default if the extension is unknown."""
+    if is_remote(name):
+        name = urlparse(name).path
+    name = name.lower()
+    gzipped = name.endswith(".gz")
+    if gzipped:
+        name = name[:-3]
+    return RDF_FORMATS.get(name.rsplit(".", 1)[-1], default), gzipped
+
+
+class LoadProgress:
+    """Counts what has been loaded so far, shared by all the loading threads, and
+    logs it every LOAD_PROGRESS_INTERVAL seconds, when it is also put in METRICS."""
+
+    def __init__(self, files_total: int):
+        self.files_total = files_total
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_read = 0
+        self.start = time.time()
+        self.last_report = self.start
+        self.lock = threading.Lock()
+        self.update_metrics()
+
+    def read(self, size: int):
+        with self.lock:
+            self.bytes_read += size
+            now = time.time()
+            if now - self.last_report < LOAD_PROGRESS_INTERVAL:
+                return
+            self.last_report = now
+        self.report()
+
+    def done(self, failed: bool = False):
+        with self.lock:
+            self.files_done += 1
+            if failed:
+                self.files_failed += 1
+        self.update_metrics()
+
+    def update_metrics(self):
+        METRICS.set("shmarql_load_files", self.files_total, state="total")
+        METRICS.set("shmarql_load_files", self.files_done, state="done")
+        METRICS.set("shmarql_load_files", self.files_failed, state="failed")
+        METRICS.set("shmarql_load_bytes", self.bytes_read)
+        METRICS.set("shmarql_load_duration_seconds", time.time() - self.start)
+
+    def report(self, quads: int = None):
+        self.update_metrics()
+        elapsed = max(time.time() - self.start, 0.001)
+        msg = (
+            f"Loaded {self.files_done}/{self.files_total} files"
+            f" ({self.files_failed} failed),"
+            f" {self.bytes_read / 1048576:.1f} MB"
+            f" at {self.bytes_read / 1048576 / elapsed:.1f} MB/s"
+        )
+        if quads is not None:
+            msg += f", {quads} quads at {int(quads / elapsed)} quads/s"
+        log.info(msg + f" in {int(elapsed)} seconds")
+
+
+class CountingReader:
+    """Wraps a binary file, reporting how much is read from it to a LoadProgress and
+    hashing it on the way. Sits below any gzip decompression, so it counts and
+    hashes the bytes as stored on disk."""
+
+    def __init__(self, file, progress: LoadProgress):
+        self.file = file
+        self.progress = progress
+        self.hash = hashlib.md5()
+
+    def read(self, size: int = -1) -> bytes:
+        data = self.file.read(size)
+        self.progress.read(len(data))
+        self.hash.update(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def expand_sources(data_load_paths: list) -> list:
+    "The URLs and files to load, with directories replaced by the files in them."
+    sources = []
+    for data_load_path in data_load_paths:
+        if os.path.isdir(data_load_path):
+            for dirpath, _, filenames in os.walk(data_load_path):
+                for filename in sorted(filenames):
+                    sources.append(os.path.join(dirpath, filename))
+        else:
+            sources.append(data_load_path)
+    return sources
+
+
+def file_hash(filepath: str) -> str:
+    digest = hashlib.md5()
+    with open(filepath, "rb") as f:
+        while chunk := f.read(1048576):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download(url: str) -> tuple:
+    """Stream url into a temporary file, so that large dumps never have to fit in
+    memory. A Content-Encoding the server used is undone on the way, files that are
+    themselves gzipped stay so. Returns the path, which the caller has to remove,
+    and the response headers."""
+    log.debug(f"Downloading {url}")
+    start_download = time.time()
+    fd, path = tempfile.mkstemp(prefix="shmarql-", suffix=os.path.basename(url))
+    try:
+        with (
+            os.fdopen(fd, "wb") as f,
+            httpx.stream("GET", url, follow_redirects=True, timeout=180) as r,
+        ):
+            r.raise_for_status()
+            for chunk in r.iter_bytes():
+                f.write(chunk)
+    except Exception:
+        os.remove(path)
+        raise
+    log.debug(f"Downloading {url} took {int(time.time() - start_download)} seconds")
+    return path, r.headers
+
+
+def load_file(store: px.Store, filepath: str, format, gzipped: bool, graph, progress):
+    "Load filepath into store, returns the hash of its contents."
+    with open(filepath, "rb") as raw:
+        reader = CountingReader(raw, progress)
+        f = gzip.GzipFile(fileobj=reader) if gzipped else reader
+        store.bulk_load(f, format, to_graph=graph, lenient=True)
+    return reader.hash.hexdigest()
+
+
+def load_source(store: px.Store, source: str, progress: LoadProgress) -> dict:
+    """Load one file or URL into the default graph of store, or for quad formats the
+    graphs in it. Remote files with an unknown extension are assumed to be Turtle.
+    Returns the manifest entry for the source, or None if it was not loaded."""
+    remote = is_remote(source)
+    format, gzipped = rdf_format(source, px.RdfFormat.TURTLE if remote else None)
+    entry = {}
+    filepath = None
+    try:
+        if remote:
+            filepath, headers = download(source)
+            entry["etag"] = headers.get("etag")
+            entry["last_modified"] = headers.get("last-modified")
+        else:
+            filepath = source
+            stat = os.stat(source)
+            entry["size"] = stat.st_size
+            entry["mtime"] = stat.st_mtime_ns
+        log.debug(f"Parsing {source} as {format}")
+        entry["hash"] = load_file(store, filepath, format, gzipped, None, progress)
+    except Exception as e:
+        log.error(f"Failed to load {source}: {e}")
+        progress.done(failed=True)
+        return None
+    finally:
+        if remote and filepath:
+            os.remove(filepath)
+    progress.done()
+    return entry
+
+
+def source_unchanged(source: str, entry: dict) -> bool:
+    """Compare a source with its manifest entry. Local files with the same size and
+    mtime are taken to be unchanged, otherwise their contents are hashed. Remote
+    files are asked for their ETag or Last-Modified with a HEAD request."""
+    if is_remote(source):
+        try:
+            r = httpx.head(source, follow_redirects=True, timeout=180)
+        except httpx.HTTPError:
+            return False
+        if r.status_code != 200:
+            return False
+        for field, header in (("etag", "etag"), ("last_modified", "last-modified")):
+            if entry.get(field) and entry[field] == r.headers.get(header):
+                return True
+        return False
+    try:
+        stat = os.stat(source)
+    except OSError:
+        return False
+    if stat.st_size == entry.get("size") and stat.st_mtime_ns == entry.get("mtime"):
+        return True
+    if stat.st_size == entry.get("size") and file_hash(source) == entry.get("hash"):
+        # Only touched, remember the new mtime so it is not hashed again
+        entry["mtime"] = stat.st_mtime_ns
+        return True
+    return False
+
+
+MANIFEST_FILENAME = "shmarql-manifest.json"
+
+
+def read_manifest(store_path: str) -> dict:
+    try:
+        with open(os.path.join(store_path, MANIFEST_FILENAME)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_manifest(store_path: str, manifest: dict):
+    manifest_path = os.path.join(store_path, MANIFEST_FILENAME)
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+READY_FILENAME = "shmarql-ready.json"
+LOCK_FILENAME = "shmarql.lock"
+
+
+def lock_store(store_path: str):
+    """Try to become the process that loads the store at store_path. Returns the
+    locked file, which has to be kept open until loading is done, or None if another
+    process holds the lock. The lock is released by the OS if a loader dies."""
+    os.makedirs(store_path, exist_ok=True)
+    lock_file = open(os.path.join(store_path, LOCK_FILENAME), "w")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def read_ready(store_path: str) -> dict:
+    """The marker a loader writes once the store is completely loaded, with the
+    number of quads and data version, or None while it is not ready."""
+    try:
+        with open(os.path.join(store_path, READY_FILENAME)) as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def write_ready(store_path: str, ready: dict):
+    ready_path = os.path.join(store_path, READY_FILENAME)
+    with open(ready_path + ".tmp", "w") as f:
+        json.dump(ready, f)
+    os.replace(ready_path + ".tmp", ready_path)
+
+
+def clear_ready(store_path: str):
+    try:
+        os.remove(os.path.join(store_path, READY_FILENAME))
+    except FileNotFoundError:
+        pass
+
+
+def load_sources(
+    store: px.Store,
+    data_load_paths: list,
+    store_path: str = None,
+    workers: int = LOAD_WORKERS,
+    changing=None,
+):
+    """Bring store up to date with DATA_LOAD_PATHS, up to workers files at a time.
+    pyoxigraph releases the GIL while parsing, so independent files load in parallel.
+
+    Triples go into the default graph, where a triple that is in several sources is
+    only once, sources in a quad format (TriG, N-Quads) bring their own graphs. An
+    in-memory store is loaded from scratch on every start. For a persistent store
+    what was loaded is recorded in a manifest in the store_path, and on the next
+    start only new sources are loaded. Which triples came from a source that changed
+    or was removed can not be told any more, then the store is loaded from scratch.
+    changing is called before the store is changed, if it is.
+    Returns the manifest, and a LoadProgress or None if there was nothing to load.
+    The manifest is None for a store that already has data but no manifest."""
+    sources = [
+        source
+        for source in expand_sources(data_load_paths)
+        if is_remote(source) or rdf_format(source)[0]
+    ]
+    manifest = read_manifest(store_path) if store_path else None
+    if manifest is None:
+        if next(store.quads_for_pattern(None, None, None, None), None) is not None:
+            log.warning(
+                f"Store {store_path} has data but no {MANIFEST_FILENAME}, not loading"
+                " DATA_LOAD_PATHS. Remove the store to rebuild it with a manifest."
+            )
+            return None, None
+        manifest = {"sources": {}}
+    entries = manifest["sources"]
+
+    stale = [
+        source
+        for source in entries
+        if source not in sources or not source_unchanged(source, entries[source])
+    ]
+    to_load = [source for source in sources if source not in entries or stale]
+    if (stale or to_load) and changing:
+        changing()
+    if stale:
+        log.info(f"{stale[0]} changed or was removed, loading the store from scratch")
+        store.clear()
+        entries.clear()
+    manifest["checked_at"] = time.time()
+    if store_path:
+        # Also saves the updated mtimes of unchanged sources
+        write_manifest(store_path, manifest)
+    if not to_load:
+        log.debug("All of DATA_LOAD_PATHS already loaded")
+        return manifest, None
+
+    progress = LoadProgress(len(to_load))
+    with ThreadPoolExecutor(workers, thread_name_prefix="shmarql-load") as executor:
+        loaded = executor.map(
+            lambda source: load_source(store, source, progress), to_load
+        )
+        for source, entry in zip(to_load, loaded):
+            if entry:
+                entries[source] = entry
+    if store_path:
+        store.flush()
+        write_manifest(store_path, manifest)
+    return manifest, progress
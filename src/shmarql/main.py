@@ -1,10 +1,14 @@
-import csv, io, string, json, os
+import string, json, asyncio, gzip
 from urllib.parse import quote, unquote_plus
 from fastapi import FastAPI, Request, HTTPException
-from fastapi.responses import Response, HTMLResponse, FileResponse, RedirectResponse
+from fastapi.responses import (
+    Response,
+    HTMLResponse,
+    RedirectResponse,
+    StreamingResponse,
+)
 from fasthtml.common import Div, to_xml
-import pyoxigraph as px
-from .px_util import OxigraphSerialization, results_to_xml
+from starlette.background import BackgroundTask
 from . import config
 from .config import (
     MOUNT,
@@ -12,14 +16,31 @@ from .config import (
     SITEDOCS_PATH,
     SITE_URI,
     PROXY_HOST,
+    STREAM_RESULTS,
+    METRICS_ENABLED,
     log,
 )
 from typing import List, Callable, Dict, Any
 
-from .qry import do_query, hash_query
+from .qry import (
+    do_query,
+    do_query_serialized,
+    stream_query,
+    hash_query,
+    init_http_clients,
+    close_http_clients,
+    readiness,
+    subject_exists,
+    RequestMemo,
+    REQUEST_MEMO,
+    WORKER_ID,
+)
 from .fragments import rt as fragments_rt
 from .fragments import fragments_sparql
 from .services import proxy_request
+from .assets import StaticFiles
+from .limits import client_id
+from .metrics import METRICS, exposition
 
 # from .am import ar as am_rt
 
@@ -29,22 +50,63 @@ app.include_router(fragments_rt)
 # app.include_router(am_rt)
 
 
+@app.middleware("http")
+async def request_memo(request: Request, call_next):
+    """Remember the do_query results for the length of the request, and report how
+    many queries it sent to the backend in an X-Backend-Queries header. A page view
+    should never need more than one. The queries are counted against the client
+    that sent the request, for the per client limits."""
+    memo = RequestMemo(client_id(request))
+    token = REQUEST_MEMO.set(memo)
+    try:
+        response = await call_next(request)
+    finally:
+        REQUEST_MEMO.reset(token)
+    response.headers["X-Backend-Queries"] = str(memo.backend_queries)
+    return response
+
+
 @app.on_event("startup")
 async def startup_event():
     log.debug(f">>>> App started up")
     await config.init_redis()
+    await init_http_clients()
+    if METRICS_ENABLED and config.redis_client:
+        app.state.metrics_publisher = asyncio.create_task(
+            METRICS.keep_publishing(WORKER_ID)
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    log.debug(f">>>> App shutting down")
+    publisher = getattr(app.state, "metrics_publisher", None)
+    if publisher is not None:
+        publisher.cancel()
+        try:
+            await publisher
+        except asyncio.CancelledError:
+            pass
+    await close_http_clients()
+
+
+STATIC_FILES = StaticFiles("static")
+SITE_FILES = StaticFiles(SITEDOCS_PATH)
 
 
 @app.get("/favicon.ico")
-def favicon():
-    return FileResponse(f"static/favicon.ico")
+def favicon(request: Request):
+    return shmarql_get_static(request, "favicon.ico")
 
 
 @app.get("/shmarql/static/{fname:path}")
 @app.get(MOUNT + "shmarql/static/{fname:path}")
 @app.get(MOUNT + "static/{fname:path}")
-def shmarql_get_static(fname: str):
-    return FileResponse(f"static/{fname}")
+def shmarql_get_static(request: Request, fname: str):
+    response = STATIC_FILES.response(request, fname)
+    if response is None:
+        raise HTTPException(404, f"File not found {fname}")
+    return response
 
 
 def make_literal_query(some_literal: dict, encode=True, limit=999):
@@ -62,22 +124,6 @@ def make_literal_query(some_literal: dict, encode=True, limit=999):
         return Q
 
 
-def json_results_to_csv(results: dict):
-    output = io.StringIO()
-    writer = csv.writer(output)
-
-    # Write header
-    writer.writerow([var for var in results.get("head", {}).get("vars", [])])
-    for row in results.get("results", {}).get("bindings", []):
-        writer.writerow(
-            [
-                row.get(var, {"value": ""})["value"]
-                for var in results.get("head", {}).get("vars", [])
-            ]
-        )
-    return output.getvalue()
-
-
 def accept_header_to_format(request: Request) -> str:
     accept_header = request.headers.get("accept")
     accept_headers_incoming = []
@@ -111,6 +157,10 @@ def accept_header_to_format(request: Request) -> str:
             return "xml"
         if ah.startswith("application/xml"):
             return "xml"
+        if ah.startswith("text/csv"):
+            return "csv"
+        if ah.startswith("text/tab-separated-values"):
+            return "tsv"
 
     return "html"
 
@@ -145,6 +195,40 @@ async def sparql(request: Request):
     return await shmarql_get(request, query)
 
 
+async def until_disconnect(request: Request, query_coro) -> dict:
+    """Await query_coro, but give up on it when the client disconnects before the
+    results are ready, so that abandoned queries do not tie up the workers."""
+    task = asyncio.create_task(query_coro)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=0.5)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            log.debug("Client disconnected, cancelling query")
+            task.cancel()
+            return {"error": "Client disconnected", "status": 499}
+
+
+def serialized_response(request: Request, results: dict, headers: dict) -> Response:
+    """Send the body from do_query_serialized, gzipped bodies are passed through
+    untouched to clients that accept that."""
+    body = results["body"]
+    headers = headers | {
+        "X-Shmarql-Duration": f"{results['duration']:.3f}",
+        "X-Shmarql-Endpoint": results["endpoint_name"],
+        "X-Shmarql-Timestamp": results["timestamp"],
+    }
+    if results.get("cached"):
+        headers["X-Shmarql-Cached"] = "1"
+    if results.get("content_encoding") == "gzip":
+        headers["Vary"] = "Accept-Encoding"
+        if "gzip" in request.headers.get("accept-encoding", ""):
+            headers["Content-Encoding"] = "gzip"
+        else:
+            body = gzip.decompress(body)
+    return Response(body, media_type=results["content_type"], headers=headers)
+
+
 @app.get(f"{MOUNT}shmarql")
 def shmarql_redir():
     return RedirectResponse(f"{MOUNT}shmarql/", status_code=303)
@@ -155,82 +239,93 @@ async def shmarql_get(
     request: Request,
     query: str = "select * where {?s ?p ?o} limit 10",
     format: str = None,
+    page: int = 1,
 ):
 
     if format is None:
         format = accept_header_to_format(request)
-    results = await do_query(query)
-    if format in ("csv", "json", "turtle", "xml"):
-        if "data" in results:
-            if format == "turtle":
-                return Response(
-                    results["data"],
-                    headers={
-                        "Content-Type": "text/turtle",
-                        "Access-Control-Allow-Origin": "*",
-                    },
-                )
-            try:
-                # if format is not turtle, but the results are bytes, try to parse it and return as json
-                tmp_store = px.Store()
-                tmp_store.bulk_load(results["data"], "text/turtle")
-                r = tmp_store.query("select * where {?s ?p ?o}")
-                results["results"] = {"bindings": OxigraphSerialization(r).json()}
-            except Exception as e:
-                results = {
-                    "error": f"{e} Query returned non-parsable data: {repr(results)[:500]}"
-                }
-
-        if format == "xml":
-            xml_data = results_to_xml(results)
-            return Response(
-                xml_data,
-                headers={
-                    "Content-Type": "application/sparql-results+xml",
-                    "Content-Disposition": f"attachment; filename={hash_query(query)}.xml",
-                    "Access-Control-Allow-Origin": "*",
-                },
-            )
 
-        if format == "csv":
-            csv_data = json_results_to_csv(results)
-
-            return Response(
-                csv_data,
-                headers={
-                    "Content-Type": "text/csv",
-                    "Content-Disposition": f"attachment; filename={hash_query(query)}.csv",
-                    "Access-Control-Allow-Origin": "*",
-                },
+    if format in ("csv", "tsv", "json", "turtle", "xml"):
+        headers = {"Access-Control-Allow-Origin": "*"}
+        if format in ("csv", "tsv", "xml"):
+            headers["Content-Disposition"] = (
+                f"attachment; filename={hash_query(query)}.{format}"
             )
-        if format == "json":
-            if "endpoint" in results:
-                del results["endpoint"]
-            return Response(
-                json.dumps(results, indent=2),
-                headers={
-                    "Content-Type": "application/sparql-results+json",
-                    "Access-Control-Allow-Origin": "*",
-                },
+
+        results = None
+        if STREAM_RESULTS and format != "turtle":
+            results = await stream_query(query, format)
+            if results and "stream" in results:
+                return StreamingResponse(
+                    results["stream"],
+                    media_type=results["content_type"],
+                    headers=headers,
+                    # Also when the client went away before the stream was read
+                    background=BackgroundTask(results["done"]),
+                )
+        if results is None:
+            results = await until_disconnect(
+                request, do_query_serialized(query, format)
             )
+        if "body" in results:
+            return serialized_response(request, results, headers)
+        headers = {"Access-Control-Allow-Origin": "*"}
+        if results.get("status") in (429, 503):
+            headers["Retry-After"] = str(results.get("retry_after", 5))
+        return Response(
+            json.dumps(results, indent=2),
+            status_code=results.get("status", 400),
+            media_type="application/json",
+            headers=headers,
+        )
+
+    results = await until_disconnect(request, do_query(query))
+    if results.get("status") in (429, 503):
+        return Response(
+            results["error"],
+            status_code=results["status"],
+            headers={
+                "Retry-After": str(results.get("retry_after", 5)),
+                "Access-Control-Allow-Origin": "*",
+            },
+        )
 
     if not SPARQL_QUERY_UI:
         return HTMLResponse(
             "<div>There is currently no SPARQL query form to be found here, call it from a command line via a POST request.</div>"
         )
 
-    sui = await fragments_sparql(query, results)
+    sui = await fragments_sparql(query, results=results, page=page)
 
     return HTMLResponse(to_xml(Div(sui, cls="mt-4")))
 
 
-from .biki import *
+@app.get(f"{MOUNT}metrics")
+async def metrics():
+    "Prometheus metrics, of all the worker processes if Redis is available."
+    if not METRICS_ENABLED:
+        raise HTTPException(404, "File not found metrics")
+    return Response(
+        exposition(await METRICS.collect_all(WORKER_ID)),
+        media_type="text/plain; version=0.0.4; charset=utf-8",
+    )
 
 
-async def entity_check(iri: str):
-    q = f"SELECT * WHERE {{ <{iri}> ?p ?o }}"
-    res = await do_query(q)
-    return len(res.get("results", {}).get("bindings", [])) > 0
+@app.get(f"{MOUNT}shmarql/ready")
+def shmarql_ready():
+    "Returns a 503 while the local store is still being loaded, for load balancers."
+    ready = readiness()
+    if ready["ready"]:
+        return ready
+    return Response(
+        json.dumps(ready),
+        status_code=503,
+        media_type="application/json",
+        headers={"Retry-After": "5"},
+    )
+
+
+from .biki import *
 
 
 @app.get(MOUNT + "{fname:path}")
@@ -250,19 +345,17 @@ async def getter(request: Request, fname: str):
     if fname == "" or fname.endswith("/"):
         new_name += "index.html"
 
-    path_to_try = os.path.join(SITEDOCS_PATH, new_name)
     if MOUNT:
-        path_to_try = os.path.join(SITEDOCS_PATH, new_name.replace(MOUNT[1:], "", 1))
-    else:
-        path_to_try = os.path.join(SITEDOCS_PATH, new_name)
+        new_name = new_name.replace(MOUNT[1:], "", 1)
 
-    log.debug(f"Trying {path_to_try}")
-    if os.path.exists(path_to_try):
-        return FileResponse(path_to_try)
+    log.debug(f"Trying {new_name} in {SITEDOCS_PATH}")
+    response = SITE_FILES.response(request, new_name)
+    if response is not None:
+        return response
 
     iri = SITE_URI + fname
     log.debug(f"Entity Checking {iri}")
-    if SITE_URI and await entity_check(iri):
+    if SITE_URI and await subject_exists(iri):
         format = accept_header_to_format(request)
         if format == "html":
             q = f"""
@@ -278,7 +371,8 @@ SELECT ?p ?o ?pp ?oo WHERE {{
         else:
             q = f"CONSTRUCT {{ <{iri}> ?p ?o }} WHERE {{ <{iri}> ?p ?o }}"
 
-        return RedirectResponse(f"{MOUNT}shmarql/?query={quote(q)}")
+        # Answered right here, instead of redirecting to shmarql/?query=
+        return await shmarql_get(request, query=q)
 
     # The default 404 from FileResponse leaks the path, make it simpler:
     raise HTTPException(404, f"File not found {fname}")
@@ -0,0 +1,232 @@
+import asyncio, json, threading, time
+from . import config
+from .config import METRICS_KEY, METRICS_PUBLISH_INTERVAL, log
+
+# Upper bounds of the histogram buckets
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 180)
+ROWS = (0, 1, 10, 100, 1000, 10000, 100000, 1000000)
+
+# What is measured: type, help text, and the buckets of histograms or how the
+# gauges of several workers are combined
+SPECS = {
+    "shmarql_query_duration_seconds": (
+        "histogram",
+        "Time to run queries on the backend, by endpoint, local or remote backend and"
+        " the format asked for, ui for the results the HTML is rendered from",
+        SECONDS,
+    ),
+    "shmarql_query_errors_total": (
+        "counter",
+        "Queries that failed, by endpoint, backend and the HTTP status returned"
+        " for them",
+        None,
+    ),
+    "shmarql_query_result_rows": (
+        "histogram",
+        "Number of rows in the results of SELECT queries, by endpoint",
+        ROWS,
+    ),
+    "shmarql_serialization_duration_seconds": (
+        "histogram",
+        "Time spent writing results in a format by the pyoxigraph serializers. For"
+        " the local store this includes evaluating the query, which happens lazily",
+        SECONDS,
+    ),
+    "shmarql_render_duration_seconds": (
+        "histogram",
+        "Time to render query results as HTML, by view: table, resource or chart",
+        SECONDS,
+    ),
+    "shmarql_rejected_queries_total": (
+        "counter",
+        "Queries turned away, by reason: the per client rate or concurrency limits,"
+        " or a full local query queue",
+        None,
+    ),
+    "shmarql_backend_queries_total": (
+        "counter",
+        "Queries sent to the local store or an endpoint",
+        None,
+    ),
+    "shmarql_local_queries_pending": (
+        "gauge",
+        "Local queries running or waiting for a worker thread",
+        "sum",
+    ),
+    "shmarql_cache_requests_total": (
+        "counter",
+        "Query result cache lookups, by cache (local or redis) and result"
+        " (hit or miss)",
+        None,
+    ),
+    "shmarql_cache_evictions_total": (
+        "counter",
+        "Entries evicted from the in-process cache to make room",
+        None,
+    ),
+    "shmarql_cache_bytes": (
+        "gauge",
+        "Size of the entries in the in-process caches",
+        "sum",
+    ),
+    "shmarql_load_files": (
+        "gauge",
+        "Files from DATA_LOAD_PATHS to load, by state: total, done and failed",
+        "max",
+    ),
+    "shmarql_load_bytes": (
+        "gauge",
+        "Bytes read while loading DATA_LOAD_PATHS",
+        "max",
+    ),
+    "shmarql_load_duration_seconds": (
+        "gauge",
+        "Time spent loading DATA_LOAD_PATHS so far",
+        "max",
+    ),
+    "shmarql_data_quads": (
+        "gauge",
+        "Number of quads in the local store",
+        "max",
+    ),
+}
+
+
+def label_value(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def label_string(labels: dict) -> str:
+    return ",".join(f'{k}="{label_value(v)}"' for k, v in labels.items())
+
+
+class Metrics:
+    """Counters, gauges and histograms of this process, keyed on name and label
+    string. Updated from the event loop and the query threads alike."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.series = {name: {} for name in SPECS}
+        # Called before every snapshot, to take readings of values kept elsewhere
+        self.collectors = []
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = label_string(labels)
+        with self.lock:
+            self.series[name][key] = self.series[name].get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        key = label_string(labels)
+        with self.lock:
+            self.series[name][key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        "Add value to a histogram, kept as the count per bucket followed by the sum."
+        buckets = SPECS[name][2]
+        key = label_string(labels)
+        with self.lock:
+            counts = self.series[name].get(key)
+            if counts is None:
+                counts = self.series[name][key] = [0] * (len(buckets) + 2)
+            i = 0
+            while i < len(buckets) and value > buckets[i]:
+                i += 1
+            counts[i] += 1
+            counts[-1] += value
+
+    def snapshot(self) -> dict:
+        for collect in self.collectors:
+            try:
+                collect(self)
+            except Exception:
+                log.exception("Problem collecting metrics")
+        with self.lock:
+            return {
+                name: {
+                    key: list(v) if isinstance(v, list) else v
+                    for key, v in series.items()
+                }
+                for name, series in self.series.items()
+            }
+
+    async def publish(self, worker_id: str):
+        """Put the snapshot of this process in the METRICS_KEY hash in Redis, for
+        /metrics in other workers."""
+        if config.redis_client:
+            snapshot = {"at": time.time(), "metrics": self.snapshot()}
+            await config.redis_client.hset(METRICS_KEY, worker_id, json.dumps(snapshot))
+
+    async def keep_publishing(self, worker_id: str):
+        while True:
+            try:
+                await self.publish(worker_id)
+            except Exception as e:
+                log.warning(f"Publishing metrics failed: {e}")
+            await asyncio.sleep(METRICS_PUBLISH_INTERVAL)
+
+    async def collect_all(self, worker_id: str) -> dict:
+        """The snapshots of all the workers of this site that published one
+        recently, combined. Workers that stopped publishing are removed from the
+        hash, their counters and histograms drop out, which Prometheus handles as a
+        counter reset."""
+        if not config.redis_client:
+            return self.snapshot()
+        await self.publish(worker_id)
+        snapshots, gone = [], []
+        for worker, value in (await config.redis_client.hgetall(METRICS_KEY)).items():
+            snapshot = json.loads(value)
+            if snapshot["at"] < time.time() - METRICS_PUBLISH_INTERVAL * 3:
+                gone.append(worker)
+            else:
+                snapshots.append(snapshot["metrics"])
+        if gone:
+            await config.redis_client.hdel(METRICS_KEY, *gone)
+        return merge(snapshots)
+
+
+def merge(snapshots: list) -> dict:
+    merged = {name: {} for name in SPECS}
+    for snapshot in snapshots:
+        for name, series in snapshot.items():
+            if name not in SPECS:
+                continue
+            kind, _, aggregate = SPECS[name]
+            for key, value in series.items():
+                if key not in merged[name]:
+                    merged[name][key] = value
+                elif kind == "histogram":
+                    merged[name][key] = [
+                        a + b for a, b in zip(merged[name][key], value)
+                    ]
+                elif kind == "gauge" and aggregate == "max":
+                    merged[name][key] = max(merged[name][key], value)
+                else:
+                    merged[name][key] = merged[name][key] + value
+    return merged
+
+
+def exposition(snapshot: dict) -> str:
+    "A snapshot in the Prometheus text format."
+    lines = []
+    for name, (kind, help, buckets) in SPECS.items():
+        series = snapshot.get(name)
+        if not series:
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {kind}")
+        for key, value in sorted(series.items()):
+            if kind != "histogram":
+                lines.append(f"{name}{{{key}}} {value}" if key else f"{name} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], value[:-1]):
+                cumulative += count
+                le = ",".join(filter(None, [key, f'le="{bound}"']))
+                lines.append(f"{name}_bucket{{{le}}} {cumulative}")
+            labels = f"{{{key}}}" if key else ""
+            lines.append(f"{name}_sum{labels} {value[-1]}")
+            lines.append(f"{name}_count{labels} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
@@ -4,17 +4,15 @@ from pyoxigraph import (
     BlankNode,
     Quad,
     QuerySolutions,
+    QueryBoolean,
     QueryTriples,
     Store,
     Variable,
     RdfFormat,
+    QueryResultsFormat,
 )
 from io import BytesIO
-import logging
-from rdflib.plugins.sparql.results.xmlresults import SPARQLXMLWriter
-from xml.sax.xmlreader import AttributesNSImpl
-from xml.dom import XML_NAMESPACE
-import pandas as pd
+import bisect, logging, os, threading
 from typing import Union
 from .config import PREFIXES
 
@@ -27,6 +25,77 @@ def string_iterator(graph: Store):
 class SerializationException(Exception): ...
 
 
+class QueryCancelled(Exception): ...
+
+
+class ResultTooLarge(Exception): ...
+
+
+class ChunkWriter:
+    """A file-like object to hand to the pyoxigraph serializers, which passes
+    on what is written to emit in chunks of at least chunk_size bytes. Writing
+    more than max_bytes in total raises ResultTooLarge, 0 for no limit."""
+
+    def __init__(self, emit, chunk_size: int = 65536, max_bytes: int = 0):
+        self.emit = emit
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.buf = []
+        self.size = 0
+        self.written = 0
+
+    def write(self, data: bytes) -> int:
+        self.written += len(data)
+        if self.max_bytes and self.written > self.max_bytes:
+            raise ResultTooLarge()
+        self.buf.append(bytes(data))
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush_chunk()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def flush_chunk(self):
+        if self.buf:
+            chunk = b"".join(self.buf)
+            self.buf = []
+            self.size = 0
+            self.emit(chunk)
+
+    def close(self):
+        self.flush_chunk()
+
+
+# The formats that results can be sent to clients in, with their content-type
+RESULTS_FORMATS = {
+    "json": (QueryResultsFormat.JSON, "application/sparql-results+json"),
+    "xml": (QueryResultsFormat.XML, "application/sparql-results+xml"),
+    "csv": (QueryResultsFormat.CSV, "text/csv"),
+    "tsv": (QueryResultsFormat.TSV, "text/tab-separated-values"),
+    "turtle": (RdfFormat.TURTLE, "text/turtle"),
+}
+
+
+def serialize_results(result, format: str, output) -> str:
+    """Write the result of a Store.query() or parse_query_results() call to output
+    with the native pyoxigraph serializers, and return the content-type used.
+    Graph results are written as Turtle if that is asked for, and as s/p/o solutions
+    otherwise. Solutions can not be written as Turtle, they are sent as JSON instead."""
+    if isinstance(result, QueryTriples):
+        if format == "turtle":
+            result.serialize(output, RdfFormat.TURTLE)
+            return RESULTS_FORMATS["turtle"][1]
+        tmp_store = Store()
+        tmp_store.extend(Quad(t.subject, t.predicate, t.object) for t in result)
+        result = tmp_store.query("SELECT ?s ?p ?o WHERE { ?s ?p ?o }")
+    if format == "turtle":
+        format = "json"
+    result.serialize(output, RESULTS_FORMATS[format][0])
+    return RESULTS_FORMATS[format][1]
+
+
 def termJSON(term):
     if isinstance(term, NamedNode):
         return {"type": "uri", "value": term.value}
@@ -52,11 +121,13 @@ class OxigraphSerialization:
     def __init__(self, result):
         self.result = result
 
-    def json(self):
+    def json(self, cancelled: threading.Event = None, max_rows: int = 0):
         if type(self.result) in (QuerySolutions, SynthQuerySolutions):
-            return self.qr_json()
+            return self.qr_json(cancelled, max_rows)
         elif type(self.result) == QueryTriples:
             return self.qt_json()
+        elif type(self.result) == QueryBoolean:
+            return {"head": {}, "boolean": bool(self.result)}
 
     def to_store(self) -> Store:
         tmp_store = Store()
@@ -76,10 +147,19 @@ class OxigraphSerialization:
         tmp_store.dump(buf, "text/turtle")
         return buf.getvalue().decode("utf8")
 
-    def qr_json(self):
+    def qr_json(self, cancelled: threading.Event = None, max_rows: int = 0):
+        "The solutions as SPARQL JSON, marked truncated if there are over max_rows."
         result = {"head": {"vars": [x.value for x in self.result.variables]}}
         rows = []
         for qs in self.result:
+            if max_rows and len(rows) == max_rows:
+                result["truncated"] = True
+                break
+            # Solutions are computed lazily while iterating, so this is where a
+            # query that nobody is waiting for any more can be stopped. Checking
+            # the event is cheap next to computing a solution, so do it for each.
+            if cancelled is not None and cancelled.is_set():
+                raise QueryCancelled()
             row = {}
             for var in self.result.variables:
                 if qs[var] is not None:
@@ -88,78 +168,6 @@ class OxigraphSerialization:
         result["results"] = {"bindings": rows}
         return result
 
-    def xml(self):
-        SPARQL_XML_NAMESPACE = "http://www.w3.org/2005/sparql-results#"
-        if type(self.result) in (QuerySolutions, SynthQuerySolutions):
-            stream = BytesIO()
-            sxw = SPARQLXMLWriter(stream, encoding="utf-8")
-            vars = [v.value for v in self.result.variables]
-            sxw.write_header(vars)
-            sxw.write_results_header()
-            for qs in self.result:
-                sxw.write_start_result()
-                for name in vars:
-                    if qs[name] is not None:
-                        attr_vals = {
-                            (None, "name"): str(name),
-                        }
-                        attr_qnames = {
-                            (None, "name"): "name",
-                        }
-                        sxw.writer.startElementNS(
-                            (SPARQL_XML_NAMESPACE, "binding"),
-                            "binding",
-                            AttributesNSImpl(attr_vals, attr_qnames),
-                        )
-                        val = qs[name]
-                        if type(val) == NamedNode:
-                            sxw.writer.startElementNS(
-                                (SPARQL_XML_NAMESPACE, "uri"),
-                                "uri",
-                                AttributesNSImpl({}, {}),
-                            )
-                            sxw.writer.characters(val.value)
-                            sxw.writer.endElementNS(
-                                (SPARQL_XML_NAMESPACE, "uri"), "uri"
-                            )
-                        elif type(val) == BlankNode:
-                            sxw.writer.startElementNS(
-                                (SPARQL_XML_NAMESPACE, "bnode"),
-                                "bnode",
-                                AttributesNSImpl({}, {}),
-                            )
-                            sxw.writer.characters(val.value)
-                            sxw.writer.endElementNS(
-                                (SPARQL_XML_NAMESPACE, "bnode"), "bnode"
-                            )
-                        elif type(val) == Literal:
-                            attr_vals = {}
-                            attr_qnames = {}
-                            if val.language:
-                                attr_vals[(XML_NAMESPACE, "lang")] = val.language
-                                attr_qnames[(XML_NAMESPACE, "lang")] = "xml:lang"
-                            elif val.datatype:
-                                attr_vals[(None, "datatype")] = val.datatype.value
-                                attr_qnames[(None, "datatype")] = "datatype"
-
-                            sxw.writer.startElementNS(
-                                (SPARQL_XML_NAMESPACE, "literal"),
-                                "literal",
-                                AttributesNSImpl(attr_vals, attr_qnames),
-                            )
-                            sxw.writer.characters(val.value)
-                            sxw.writer.endElementNS(
-                                (SPARQL_XML_NAMESPACE, "literal"), "literal"
-                            )
-
-                        sxw.writer.endElementNS(
-                            (SPARQL_XML_NAMESPACE, "binding"), "binding"
-                        )
-
-                sxw.write_end_result()
-            sxw.close()
-            return stream.getvalue().decode("utf8")
-
 
 class SynthQuerySolutions:
     variables = [Variable("s"), Variable("p"), Variable("o")]
@@ -239,95 +247,106 @@ def results_to_triples(results: dict, vars: dict):
     return buf
 
 
-def results_to_xml(results: dict) -> str:
-    SPARQL_XML_NAMESPACE = "http://www.w3.org/2005/sparql-results#"
-    stream = BytesIO()
-    sxw = SPARQLXMLWriter(stream, encoding="utf-8")
-    vars = results.get("head", {}).get("vars", [])
-    sxw.write_header(vars)
-    sxw.write_results_header()
-    for qs in results.get("results", {}).get("bindings", []):
-        sxw.write_start_result()
-        for name in vars:
-            if qs.get(name) is not None:
-                attr_vals = {
-                    (None, "name"): name,
-                }
-                attr_qnames = {
-                    (None, "name"): "name",
-                }
-                sxw.writer.startElementNS(
-                    (SPARQL_XML_NAMESPACE, "binding"),
-                    "binding",
-                    AttributesNSImpl(attr_vals, attr_qnames),
-                )
-                val = qs.get(name)
-                if val.get("type") == "uri":
-                    sxw.writer.startElementNS(
-                        (SPARQL_XML_NAMESPACE, "uri"),
-                        "uri",
-                        AttributesNSImpl({}, {}),
-                    )
-                    sxw.writer.characters(val.get("value"))
-                    sxw.writer.endElementNS((SPARQL_XML_NAMESPACE, "uri"), "uri")
-                elif val.get("type") == "bnode":
-                    sxw.writer.startElementNS(
-                        (SPARQL_XML_NAMESPACE, "bnode"),
-                        "bnode",
-                        AttributesNSImpl({}, {}),
-                    )
-                    sxw.writer.characters(val.get("value"))
-                    sxw.writer.endElementNS((SPARQL_XML_NAMESPACE, "bnode"), "bnode")
-                elif type(val) == "literal":
-                    attr_vals = {}
-                    attr_qnames = {}
-                    if val.get("xml:lang"):
-                        attr_vals[(XML_NAMESPACE, "lang")] = val.get("xml:lang")
-                        attr_qnames[(XML_NAMESPACE, "lang")] = "xml:lang"
-                    elif val.get("datatype"):
-                        attr_vals[(None, "datatype")] = val.get("datatype")
-                        attr_qnames[(None, "datatype")] = "datatype"
-
-                    sxw.writer.startElementNS(
-                        (SPARQL_XML_NAMESPACE, "literal"),
-                        "literal",
-                        AttributesNSImpl(attr_vals, attr_qnames),
-                    )
-                    sxw.writer.characters(val.get("value"))
-                    sxw.writer.endElementNS(
-                        (SPARQL_XML_NAMESPACE, "literal"), "literal"
-                    )
-
-                sxw.writer.endElementNS((SPARQL_XML_NAMESPACE, "binding"), "binding")
-
-        sxw.write_end_result()
-    sxw.close()
-    return stream.getvalue().decode("utf8")
-
-
-def results_to_df(results: dict) -> pd.DataFrame:
-    data = {}
+XSD = "http://www.w3.org/2001/XMLSchema#"
+NUMERIC_DATATYPES = {
+    XSD + name
+    for name in "integer int long short byte decimal double float unsignedLong"
+    " unsignedInt unsignedShort unsignedByte nonNegativeInteger positiveInteger"
+    " negativeInteger nonPositiveInteger".split()
+}
+DATE_DATATYPES = {XSD + "date", XSD + "dateTime", XSD + "dateTimeStamp"}
+
+
+def results_to_column(terms: list) -> "pd.Series":
+    """The values of one variable in SPARQL JSON results as a typed column. If all
+    the literals in it are numbers or dates the column has that type, parsed in one
+    go by pandas, and values that do not parse become NaN/NaT. Otherwise, like for
+    IRIs and geo:wktLiteral, it is a column of strings."""
+    import pandas as pd
+
+    values = [term["value"] if term else None for term in terms]
+    datatypes = {term.get("datatype") for term in terms if term}
+    if datatypes and datatypes <= NUMERIC_DATATYPES:
+        return pd.to_numeric(pd.Series(values), errors="coerce")
+    if datatypes and datatypes <= DATE_DATATYPES:
+        return pd.to_datetime(
+            pd.Series(values), errors="coerce", utc=True, format="ISO8601"
+        )
+    return pd.Series(values, dtype=object)
+
+
+def results_to_df(results: dict) -> "pd.DataFrame":
+    "SPARQL JSON results as a DataFrame, with a typed column for each variable."
+    import pandas as pd
+
     vars = results.get("head", {}).get("vars", [])
-    for row in results.get("results", {}).get("bindings", []):
-        for var in vars:
-            val = row.get(var)
-            data.setdefault(var, []).append(val.get("value") if val else None)
-    # this loses the type of the item in the results!
-    return pd.DataFrame(data)
+    bindings = results.get("results", {}).get("bindings", [])
+    return pd.DataFrame(
+        {var: results_to_column([row.get(var) for row in bindings]) for var in vars}
+    )
+
+
+def prefix_column(column: "pd.Series") -> "pd.Series":
+    """do_prefixes for a whole column of IRIs, calling the prefix resolver only once
+    for every distinct value instead of for every row. Columns of numbers or dates
+    are returned as they are."""
+    import pandas as pd
+
+    if not pd.api.types.is_object_dtype(column):
+        return column
+    resolver = prefix_resolver()
+    prefixed = {value: resolver.compact(value) for value in column.dropna().unique()}
+    return column.map(prefixed)
+
+
+class PrefixResolver:
+    """Finds the longest namespace in prefixes that an IRI starts with, by binary
+    search in the sorted namespaces. If the namespace just before the IRI is not a
+    prefix of it, any namespace that is has to be a prefix of what the two have in
+    common, so the search is repeated for that, which takes a step or two."""
+
+    def __init__(self, prefixes: dict):
+        self.prefixes = prefixes
+        self.namespaces = sorted(prefixes)
+
+    def namespace(self, iri: str) -> str:
+        key = iri
+        while key:
+            i = bisect.bisect_right(self.namespaces, key)
+            if i == 0:
+                return None
+            namespace = self.namespaces[i - 1]
+            if iri.startswith(namespace):
+                return namespace
+            key = os.path.commonprefix([key, namespace])
+        return None
 
+    def compact(self, iri: str) -> str:
+        namespace = self.namespace(iri)
+        if namespace is None:
+            return iri
+        return self.prefixes[namespace] + iri[len(namespace) :]
 
-def do_prefixes(iris: Union[str, list], pfxs: dict = {}):
-    """Given a list of IRI values, return a string with the IRIs prefixed"""
+
+# Resolvers for PREFIXES plus the extra prefixes of queries
+PREFIX_RESOLVERS = {}
+
+
+def prefix_resolver(extra: dict = None) -> PrefixResolver:
+    key = tuple(extra.items()) if extra else ()
+    resolver = PREFIX_RESOLVERS.get(key)
+    if resolver is None:
+        if len(PREFIX_RESOLVERS) > 1000:
+            PREFIX_RESOLVERS.clear()
+        # PREFIXES win over the ones in the query, as they always have
+        resolver = PREFIX_RESOLVERS[key] = PrefixResolver((extra or {}) | PREFIXES)
+    return resolver
+
+
+def do_prefixes(iris: Union[str, list], pfxs: dict = None):
+    """Given a list of IRI values, return a string with the IRIs prefixed, using the
+    longest matching namespace in PREFIXES and pfxs"""
     if isinstance(iris, str):
         iris = [iris]
-    buf = []
-    pfxs.update(PREFIXES)
-    for iri in iris:
-        found = False
-        for uri, prefix in pfxs.items():
-            if iri.startswith(uri):
-                buf.append(f"{prefix}{iri[len(uri):]}")
-                found = True
-        if not found:
-            buf.append(iri)
-    return " ".join(buf)
+    resolver = prefix_resolver(pfxs)
+    return " ".join(resolver.compact(iri) for iri in iris)
@@ -2,34 +2,593 @@ from datetime import datetime
 from unittest import result
 
 import httpx, logging, random, hashlib, json, time, sqlite3, os, gzip
-import fizzysearch
+import asyncio, threading, importlib.util, contextvars
+from concurrent.futures import ThreadPoolExecutor, Future
 from . import config
 from .config import (
     ENDPOINT,
     ENDPOINTS,
+    ENDPOINT_TIMEOUT,
+    ENDPOINT_MAX_CONNECTIONS,
+    ENDPOINT_MAX_KEEPALIVE,
+    ENDPOINT_KEEPALIVE_EXPIRY,
+    ENDPOINT_HTTP2,
     BIKIDATA_DB,
     PREFIXES_SNIPPET,
     DATA_LOAD_PATHS,
     STORE_PATH,
+    STORE_POLL_INTERVAL,
+    STORE_VERSION,
+    STORE_EXTERNAL,
+    LOCAL_QUERY_WORKERS,
+    LOCAL_QUERY_QUEUE,
+    QUERY_TIMEOUT,
+    MAX_RESULT_ROWS,
+    MAX_RESULT_BYTES,
+    STREAM_CHUNK_SIZE,
+    STREAM_BUFFER_CHUNKS,
+    CACHE_COMPRESSION_LEVEL,
+    CACHE_LOCK_POLL,
+    CACHE_TTL,
+    CACHE_SOFT_TTL,
+    CACHE_REFRESH_HITS,
     log,
 )
 import pyoxigraph as px
-from .px_util import OxigraphSerialization, string_iterator
+from .cache import LOCAL_CACHE
+from .limits import LIMITER
+from .metrics import METRICS
+from .loader import (
+    load_sources,
+    expand_sources,
+    lock_store,
+    read_ready,
+    write_ready,
+    clear_ready,
+    read_manifest,
+)
+from .fts import start_index_update, fts_state
+from .px_util import (
+    OxigraphSerialization,
+    QueryCancelled,
+    ResultTooLarge,
+    ChunkWriter,
+    RESULTS_FORMATS,
+    serialize_results,
+)
+
+USER_AGENT = "SHMARQL/2024 (https://shmarql.com/ ep@epoz.org)"
+
+# One pooled AsyncClient per remote endpoint URL, so that keep-alive connections
+# are re-used between queries instead of doing a TCP/TLS handshake every time.
+HTTP_CLIENTS = {}
+
+
+def http_client(endpoint: str) -> httpx.AsyncClient:
+    client = HTTP_CLIENTS.get(endpoint)
+    if client is None:
+        client = httpx.AsyncClient(
+            http2=ENDPOINT_HTTP2 and importlib.util.find_spec("h2") is not None,
+            limits=httpx.Limits(
+                max_connections=ENDPOINT_MAX_CONNECTIONS,
+                max_keepalive_connections=ENDPOINT_MAX_KEEPALIVE,
+                keepalive_expiry=ENDPOINT_KEEPALIVE_EXPIRY,
+            ),
+            timeout=ENDPOINT_TIMEOUT,
+            headers={"User-Agent": USER_AGENT},
+        )
+        HTTP_CLIENTS[endpoint] = client
+    return client
+
+
+async def init_http_clients():
+    """Create the pooled clients for all configured endpoints up front.
+    Must be awaited from within the running event loop, the clients can not be
+    shared across loops."""
+    for endpoint in set([ENDPOINT] + list(ENDPOINTS.values())):
+        if endpoint:
+            http_client(endpoint)
+            log.debug(f"HTTP client pool created for {endpoint}")
+
+
+async def close_http_clients():
+    while HTTP_CLIENTS:
+        endpoint, client = HTTP_CLIENTS.popitem()
+        try:
+            await client.aclose()
+        except:
+            log.exception(f"Problem closing HTTP client for {endpoint}")
+
+
+# pyoxigraph releases the GIL while evaluating, so local queries running in
+# these threads can make use of multiple cores.
+LOCAL_QUERY_EXECUTOR = ThreadPoolExecutor(
+    max_workers=LOCAL_QUERY_WORKERS, thread_name_prefix="shmarql-query"
+)
+# Number of local queries running or waiting in the executor, only ever
+# modified from the event loop thread. A query that timed out keeps counting
+# until its thread has noticed and returned, so the limit on it is a limit on
+# the threads that are actually busy.
+local_queries_pending = 0
+
+
+def run_local_query(query: str, cancelled: threading.Event) -> dict:
+    if cancelled.is_set():
+        raise QueryCancelled()
+    # Errors are turned into results here, the exception traceback would otherwise
+    # keep the QuerySolutions alive and pyoxigraph does not allow dropping those
+    # on another thread.
+    try:
+        r = GRAPH.query(query, use_default_graph_as_union=True)
+        return OxigraphSerialization(r).json(cancelled, MAX_RESULT_ROWS)
+    except QueryCancelled:
+        return {"error": "Query cancelled"}
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def local_query_done():
+    global local_queries_pending
+    local_queries_pending -= 1
+
+
+def submit_local_query(fn, *args):
+    """Submit fn to the LOCAL_QUERY_EXECUTOR, or return None if there are
+    already too many local queries running and waiting."""
+    global local_queries_pending
+    if local_queries_pending >= LOCAL_QUERY_WORKERS + LOCAL_QUERY_QUEUE:
+        log.debug(f"Rejecting local query, {local_queries_pending} already pending")
+        METRICS.inc("shmarql_rejected_queries_total", reason="queue")
+        return None
+    loop = asyncio.get_running_loop()
+    local_queries_pending += 1
+    future = LOCAL_QUERY_EXECUTOR.submit(fn, *args)
+    future.add_done_callback(lambda _: loop.call_soon_threadsafe(local_query_done))
+    return future
+
+
+def timed_out() -> dict:
+    return {"error": f"Query took longer than {QUERY_TIMEOUT:g} seconds", "status": 504}
+
+
+def too_large() -> dict:
+    return {
+        "error": f"Results are larger than {MAX_RESULT_BYTES} bytes, try a LIMIT",
+        "status": 413,
+    }
+
+
+async def await_local_query(future: Future, cancelled: threading.Event) -> dict:
+    """Wait at most QUERY_TIMEOUT seconds for a query submitted with
+    submit_local_query. If it takes longer, or the awaiting task is cancelled (for
+    example because the client went away), the query is abandoned as soon as the
+    worker thread notices."""
+    try:
+        return await asyncio.wait_for(
+            asyncio.wrap_future(future), QUERY_TIMEOUT or None
+        )
+    except asyncio.TimeoutError:
+        log.debug("Local query timed out")
+        cancelled.set()
+        return timed_out()
+    except asyncio.CancelledError:
+        log.debug("Local query cancelled")
+        cancelled.set()
+        raise
+
+
+async def do_local_query(query: str) -> dict:
+    "Run query against the local GRAPH in the LOCAL_QUERY_EXECUTOR."
+    cancelled = threading.Event()
+    future = submit_local_query(run_local_query, query, cancelled)
+    if future is None:
+        return {"error": "Too many queries in progress, try again later", "status": 503}
+    return await await_local_query(future, cancelled)
+
+
+def serialize_local_query(query: str, format: str, writer: ChunkWriter) -> dict:
+    # As in run_local_query, do not let exceptions escape this thread
+    try:
+        start = time.time()
+        r = GRAPH.query(query, use_default_graph_as_union=True)
+        content_type = serialize_results(r, format, writer)
+        writer.close()
+        METRICS.observe(
+            "shmarql_serialization_duration_seconds", time.time() - start, format=format
+        )
+        return {"content_type": content_type}
+    except QueryCancelled:
+        return {"error": "Query cancelled"}
+    except ResultTooLarge:
+        return too_large()
+    except Exception as e:
+        return {"error": str(e)}
+
+
+def convert_remote_results(
+    content: bytes, construct: bool, format: str, writer: ChunkWriter
+) -> dict:
+    """Re-serialize the SPARQL JSON (or for construct queries, Turtle) that a
+    remote endpoint returned into format."""
+    try:
+        start = time.time()
+        if construct:
+            tmp_store = px.Store()
+            tmp_store.bulk_load(content, px.RdfFormat.TURTLE, lenient=True)
+            r = tmp_store.query("CONSTRUCT WHERE { ?s ?p ?o }")
+        else:
+            r = px.parse_query_results(content, px.QueryResultsFormat.JSON)
+        content_type = serialize_results(r, format, writer)
+        writer.close()
+        METRICS.observe(
+            "shmarql_serialization_duration_seconds", time.time() - start, format=format
+        )
+        return {"content_type": content_type}
+    except QueryCancelled:
+        return {"error": "Query cancelled"}
+    except ResultTooLarge:
+        return too_large()
+    except Exception as e:
+        return {"error": f"{e} Query returned non-parsable data: {content[:500]}"}
+
+
+async def stream_query(query: str, format: str):
+    """Run a SELECT or ASK query against the local GRAPH, serializing the results
+    directly into format in a worker thread. Returns None if the query can not
+    be streamed, an error dict, or a dict with an async iterator of the bytes
+    to send in "stream", and in "done" a coroutine function to call once the
+    response is over, however it ended. At most STREAM_BUFFER_CHUNKS chunks are
+    held in memory, the worker waits for the client to catch up, but not beyond
+    QUERY_TIMEOUT."""
+    prepared = prepare_query(query)
+    if prepared.get("endpoint") != "__local__":
+        return None
+    if prepared["query_type"] not in ("select", "ask"):
+        return None
+    client = request_client()
+    rejected, counted = await LIMITER.admit(client) if client else (None, None)
+    if rejected:
+        return rejected
+    count_backend_query()
+
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    slots = threading.Semaphore(STREAM_BUFFER_CHUNKS)
+    cancelled = threading.Event()
+    start = time.time()
+    deadline = start + QUERY_TIMEOUT if QUERY_TIMEOUT else None
+
+    def emit(chunk: bytes):
+        # Called in the worker thread, blocks while the buffer is full
+        while not slots.acquire(timeout=0.1):
+            if deadline and time.time() > deadline:
+                cancelled.set()
+            if cancelled.is_set():
+                raise QueryCancelled()
+        if deadline and time.time() > deadline:
+            cancelled.set()
+        if cancelled.is_set():
+            raise QueryCancelled()
+        loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+
+    released, watchdog = False, None
+
+    async def done():
+        nonlocal released
+        cancelled.set()
+        if watchdog is not None and watchdog is not asyncio.current_task():
+            watchdog.cancel()
+        if client and not released:
+            released = True
+            await LIMITER.release(client, counted)
 
+    async def expire():
+        # The response may never be read, or not even be started, which leaves it
+        # to this to stop the query and release the client once it is out of time
+        await asyncio.sleep(QUERY_TIMEOUT)
+        await done()
 
-def hash_query(query: str, endpoint: str = "") -> str:
-    return hashlib.md5((query + endpoint).encode("utf8")).hexdigest()
+    if deadline:
+        watchdog = asyncio.ensure_future(expire())
+        STREAM_WATCHDOGS.add(watchdog)
+        watchdog.add_done_callback(STREAM_WATCHDOGS.discard)
+
+    future = submit_local_query(
+        serialize_local_query,
+        PREFIXES_SNIPPET + "\n" + prepared["query"],
+        format,
+        ChunkWriter(emit, STREAM_CHUNK_SIZE, MAX_RESULT_BYTES),
+    )
+    if future is None:
+        await done()
+        return {"error": "Too many queries in progress, try again later", "status": 503}
+    # The finished future is queued after the last chunk and marks the end
+    future.add_done_callback(lambda f: loop.call_soon_threadsafe(chunks.put_nowait, f))
+
+    try:
+        first = await asyncio.wait_for(chunks.get(), QUERY_TIMEOUT or None)
+    except asyncio.TimeoutError:
+        await done()
+        return timed_out()
+    except asyncio.CancelledError:
+        await done()
+        raise
+    if isinstance(first, Future) and "error" in first.result():
+        await done()
+        return first.result()
+
+    async def stream():
+        # Once the first chunk is sent the status can not change any more, results
+        # that run into QUERY_TIMEOUT or MAX_RESULT_BYTES are cut off
+        item = first
+        try:
+            while not isinstance(item, Future):
+                slots.release()
+                yield item
+                item = await chunks.get()
+            if "error" in item.result():
+                log.error(f"Streaming query stopped: {item.result()['error']}")
+            else:
+                METRICS.observe(
+                    "shmarql_query_duration_seconds",
+                    time.time() - start,
+                    endpoint=endpoint_name("__local__"),
+                    backend="local",
+                    format=format,
+                )
+        finally:
+            await done()
+
+    return {
+        "stream": stream(),
+        "done": done,
+        "content_type": RESULTS_FORMATS[format][1],
+    }
+
+
+# Strong references to the tasks that stop streamed queries at QUERY_TIMEOUT
+STREAM_WATCHDOGS = set()
+
+
+# When this process started, the store is not checked again if another process did
+# so since then
+STARTED_AT = time.time()
+
+# Set by use_store: the local GRAPH, or None while it is being loaded, the number of
+# quads in it, and a fingerprint of the data it was loaded from, which is part of the
+# cache key for local queries.
+GRAPH = None
+DATA_QUADS = 0
+DATA_VERSION = ""
+
+
+def hash_query(query: str, endpoint: str = "", format: str = "") -> str:
+    if endpoint == "__local__":
+        # Reloading the data changes the keys, so old results are never served
+        endpoint += DATA_VERSION
+    hashed = hashlib.md5((query + endpoint).encode("utf8")).hexdigest()
+    if format:
+        return f"{hashed}.{format}"
+    return hashed
+
+
+def endpoint_name(endpoint: str) -> str:
+    for k, v in ENDPOINTS.items():
+        if v == endpoint:
+            return k
+    return "default"
 
 
 async def cached_query(query: str, endpoint: str = ""):
+    key = hash_query(query, endpoint)
+    result = LOCAL_CACHE.get(key)
+    if result:
+        log.debug(f"Local cache hit for query {key}")
+        # A shallow copy, so that the cached entry itself is never modified
+        return result | {"cached": True}
     if config.redis_client:
-        log.debug(f"Checking cache for query {hash_query(query, endpoint)}")
-        cached_q = await config.redis_client.get(hash_query(query, endpoint))
+        log.debug(f"Checking cache for query {key}")
+        cached_q = await config.redis_client.get(key)
         if cached_q:
             result = json.loads(cached_q)
-            result["cached"] = True
-            log.debug(f"Cache hit for query {hash_query(query, endpoint)}")
+            LOCAL_CACHE.set(key, result, len(cached_q))
+            log.debug(f"Cache hit for query {key}")
+            METRICS.inc("shmarql_cache_requests_total", cache="redis", result="hit")
+            return result | {"cached": True}
+        METRICS.inc("shmarql_cache_requests_total", cache="redis", result="miss")
+
+
+async def cached_body(key: str):
+    """Fetch a serialized result from the cache with a single HGETALL. The body
+    is returned as stored, gzipped, so it can be sent to the client as is."""
+    result = LOCAL_CACHE.get(key)
+    if result:
+        log.debug(f"Local cache hit for serialized query {key}")
+        return result | {"cached": True}
+    if config.redis_client:
+        cached = await config.redis_client.hgetall(key)
+        if cached:
+            log.debug(f"Cache hit for serialized query {key}")
+            result = {
+                "body": cached[b"body"],
+                "content_encoding": "gzip",
+                "content_type": cached[b"content_type"].decode("utf8"),
+                "duration": float(cached[b"duration"]),
+                "endpoint_name": cached[b"endpoint_name"].decode("utf8"),
+                "timestamp": cached[b"timestamp"].decode("utf8"),
+                "cached_at": float(cached.get(b"cached_at", 0)),
+            }
+            LOCAL_CACHE.set(key, result, len(result["body"]))
+            METRICS.inc("shmarql_cache_requests_total", cache="redis", result="hit")
+            return result | {"cached": True}
+        METRICS.inc("shmarql_cache_requests_total", cache="redis", result="miss")
+
+
+async def cache_body(key: str, result: dict):
+    """Store the gzipped body of a serialized result, with its metadata in
+    side fields of the same hash."""
+    LOCAL_CACHE.set(key, result, len(result["body"]))
+    if config.redis_client:
+        async with config.redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(
+                key,
+                mapping={
+                    "body": result["body"],
+                    "content_type": result["content_type"],
+                    "duration": result["duration"],
+                    "endpoint_name": result["endpoint_name"],
+                    "timestamp": result["timestamp"],
+                    "cached_at": result["cached_at"],
+                },
+            )
+            pipe.expire(key, CACHE_TTL)
+            await pipe.execute()
+
+
+class RequestMemo:
+    """What one HTTP request asked for so far. The do_query results by query, so
+    that rendering a page never runs the same query twice, and the number of
+    queries sent to the backend, the local store or an endpoint, for it. The client
+    is who the queries are counted against by the LIMITER, None for no limits."""
+
+    def __init__(self, client: str = None):
+        self.results = {}
+        self.backend_queries = 0
+        self.client = client
+
+
+# Set for every request by the middleware in main
+REQUEST_MEMO = contextvars.ContextVar("REQUEST_MEMO", default=None)
+# Queries sent to the backend by this process since it started
+backend_queries = 0
+
+
+def count_backend_query():
+    global backend_queries
+    backend_queries += 1
+    memo = REQUEST_MEMO.get()
+    if memo is not None:
+        memo.backend_queries += 1
+
+
+def request_client() -> str:
+    memo = REQUEST_MEMO.get()
+    return memo.client if memo is not None else None
+
+
+async def admitted(query_coro) -> dict:
+    """Await query_coro if the client of the current request is within its limits,
+    otherwise return the error the LIMITER gave."""
+    client = request_client()
+    if client is None:
+        return await query_coro
+    rejected, counted = await LIMITER.admit(client)
+    if rejected:
+        query_coro.close()
+        return rejected
+    try:
+        return await query_coro
+    finally:
+        await LIMITER.release(client, counted)
+
+
+# Queries currently being run by this process, keyed on their cache key, so that
+# identical queries arriving at the same time share a single execution.
+IN_FLIGHT = {}
+WORKER_ID = f"{os.getpid()}-{random.random()}"
+# Seconds that the error of a query is kept for the workers that waited on it
+ERROR_TTL = 5
+
+
+async def coalesce(key: str, compute, cached) -> dict:
+    """Return the result of compute(), unless the same key is already in flight,
+    in which case wait for that instead. The computation runs as its own task so
+    that a client going away does not fail the others waiting on it, it is only
+    cancelled once nobody is waiting anymore."""
+    flight = IN_FLIGHT.get(key)
+    if flight is None:
+        flight = {
+            "task": asyncio.ensure_future(locked_compute(key, compute, cached)),
+            "waiters": 0,
+        }
+        IN_FLIGHT[key] = flight
+        flight["task"].add_done_callback(
+            lambda _: IN_FLIGHT.pop(key) if IN_FLIGHT.get(key) is flight else None
+        )
+    else:
+        log.debug(f"Joining in-flight query {key}")
+    flight["waiters"] += 1
+    try:
+        result = await asyncio.shield(flight["task"])
+    except asyncio.CancelledError:
+        if not flight["task"].done():
+            flight["waiters"] -= 1
+            if flight["waiters"] < 1:
+                flight["task"].cancel()
+        raise
+    # Every caller gets its own copy, they are free to add to it
+    return dict(result) if result else result
+
+
+async def locked_compute(key: str, compute, cached) -> dict:
+    """With Redis, take a lock on key so that only one worker process computes a
+    missing cache entry. The others wait for the lock to be released, and then
+    return what it left: the result in the cache, or the error, which is not cached
+    but kept for them for a few seconds. They compute it themselves only if the
+    lock expired without either, and give up after QUERY_TIMEOUT."""
+    if not config.redis_client:
+        return await compute()
+    lock_key, error_key = f"lock:{key}", f"error:{key}"
+    timeout = QUERY_TIMEOUT or ENDPOINT_TIMEOUT
+    # Longer than the query may take, or another worker would run it as well
+    lock_ms = int(timeout * 1000) + 5000
+    deadline = time.time() + timeout
+    while not await config.redis_client.set(lock_key, WORKER_ID, nx=True, px=lock_ms):
+        while await config.redis_client.exists(lock_key):
+            if time.time() > deadline:
+                log.debug(f"Gave up waiting for another worker to compute {key}")
+                return timed_out()
+            await asyncio.sleep(CACHE_LOCK_POLL)
+        result = await cached()
+        if result:
+            log.debug(f"Query {key} was computed by another worker")
             return result
+        error = await config.redis_client.get(error_key)
+        if error:
+            log.debug(f"Query {key} failed in another worker")
+            return json.loads(error)
+    try:
+        result = await compute()
+        if result and "error" in result:
+            error = {k: result[k] for k in ("error", "status") if k in result}
+            await config.redis_client.set(error_key, json.dumps(error), ex=ERROR_TTL)
+        return result
+    finally:
+        if await config.redis_client.get(lock_key) == WORKER_ID.encode("utf8"):
+            await config.redis_client.delete(lock_key)
+
+
+# Hits per cache key since it was last (re)computed, to decide what is worth refreshing
+CACHE_HITS = {}
+# Strong references to the background refreshes, or they could be garbage collected
+REFRESHING = set()
+
+
+def refresh_if_stale(key: str, result: dict, compute, cached):
+    """Called on every cache hit. If result is older than CACHE_SOFT_TTL and popular
+    enough, start re-running it in the background, the caller serves result as is."""
+    if len(CACHE_HITS) > 100000:
+        CACHE_HITS.clear()
+    CACHE_HITS[key] = CACHE_HITS.get(key, 0) + 1
+    if time.time() - result.get("cached_at", 0) < CACHE_SOFT_TTL:
+        return
+    if CACHE_HITS[key] < CACHE_REFRESH_HITS or key in IN_FLIGHT:
+        return
+    log.debug(f"Refreshing stale cache entry {key}")
+    del CACHE_HITS[key]
+    task = asyncio.ensure_future(coalesce(key, compute, cached))
+    REFRESHING.add(task)
+    task.add_done_callback(REFRESHING.discard)
 
 
 def parse_prefixes(querystring: str) -> dict:
@@ -50,18 +609,47 @@ def parse_prefixes(querystring: str) -> dict:
     return prefixes
 
 
-async def do_query(query: str) -> dict:
+def load_rewriter():
+    """fizzysearch.rewrite, which every query goes through. Importing fizzysearch
+    also imports bikidata and the libraries it needs, which take longer than all of
+    the rest of startup, so that is left to the first query."""
+    from fizzysearch import rewrite
+
+    return rewrite
+
+
+def lazy_fts(name: str):
+    "A fizzysearch full-text search predicate, that only imports it when used."
+
+    def search(varname: str, value: str):
+        import fizzysearch
+
+        return getattr(fizzysearch, name)()(varname, value)
+
+    return search
+
+
+FIZZY_PREDICATES = {
+    "https://fizzysearch.ise.fiz-karlsruhe.de/fts": lazy_fts("use_fts"),
+    "fizzy:fts": lazy_fts("use_fts"),
+    "fizzy:ftsStats": lazy_fts("use_fts_stats"),
+}
+
+
+def prepare_query(query: str) -> dict:
+    """Rewrite the query with fizzysearch, collect the shmarql- settings from the
+    comments and decide which endpoint it should be sent to."""
     to_use = ENDPOINT
 
+    if "fizzy:fts" in query or "fiz-karlsruhe.de/fts" in query:
+        state = fts_state()
+        if state == "warming":
+            return {"error": "The full-text index is still being built", "status": 503}
+        if state == "failed":
+            return {"error": "The full-text index could not be built", "status": 503}
+
     try:
-        rewritten = fizzysearch.rewrite(
-            query,
-            {
-                "https://fizzysearch.ise.fiz-karlsruhe.de/fts": fizzysearch.use_fts(),
-                "fizzy:fts": fizzysearch.use_fts(),
-                "fizzy:ftsStats": fizzysearch.use_fts_stats(),
-            },
-        )
+        rewritten = load_rewriter()(query, FIZZY_PREDICATES)
     except Exception as e:
         log.exception(f"Problem with fizzysearch: {e}")
         return {"error": f"Fizzysearch rewriting error: {e}"}
@@ -78,191 +666,472 @@ async def do_query(query: str) -> dict:
                     ":".join(comment_value[1:])
                 )
 
-    query = rewritten.get("rewritten", query)
-
     if not to_use:
         if len(ENDPOINTS) > 0:
             to_use = random.choice(list(ENDPOINTS.values()))
-        elif len(GRAPH) > 0:
+        elif GRAPH is None and STORE_PATH:
+            return {"error": "The data is still being loaded", "status": 503}
+        elif DATA_QUADS > 0:
             to_use = "__local__"
         else:
             return {"error": "No endpoint found"}
 
-    if not "nocache" in shmarql_settings:
-        cached_query_result = await cached_query(query, to_use)
-        if cached_query_result:
-            return cached_query_result
+    return {
+        "query": rewritten.get("rewritten", query),
+        "query_type": rewritten.get("query_type"),
+        "endpoint": to_use,
+        "shmarql_settings": shmarql_settings,
+    }
+
+
+async def do_query(query: str) -> dict:
+    """The results of query, from the cache or the backend. Within a request the
+    results are remembered, asking for the same query again returns them as is."""
+    memo = REQUEST_MEMO.get()
+    if memo is not None and query in memo.results:
+        return memo.results[query]
+    result = await admitted(find_query(query))
+    if memo is not None:
+        memo.results[query] = result
+    return result
+
+
+async def find_query(query: str) -> dict:
+    prepared = prepare_query(query)
+    if "error" in prepared:
+        return prepared
+    query = prepared["query"]
+    to_use = prepared["endpoint"]
+    shmarql_settings = prepared["shmarql_settings"]
+
+    if "nocache" in shmarql_settings:
+        return await measured(prepared, "ui", run_query(prepared))
+    key = hash_query(query, to_use)
+    compute = lambda: measured(prepared, "ui", run_query(prepared))
+    cached = lambda: cached_query(query, to_use)
+    cached_query_result = await cached()
+    if cached_query_result:
+        refresh_if_stale(key, cached_query_result, compute, cached)
+        return cached_query_result
+    return await coalesce(key, compute, cached)
+
+
+async def subject_exists(iri: str) -> bool:
+    """Whether there are any triples about iri. The local store is asked through its
+    subject index directly, which is too quick to be worth caching, and endpoints
+    are sent an ASK query."""
+    try:
+        subject = px.NamedNode(iri)
+    except ValueError:
+        return False
+    query = f"ASK {{ {subject} ?p ?o }}"
+    if prepare_query(query).get("endpoint") == "__local__":
+        return (
+            next(GRAPH.quads_for_pattern(subject, None, None, None), None) is not None
+        )
+    return (await do_query(query)).get("boolean", False)
+
+
+async def measured(prepared: dict, format: str, query_coro) -> dict:
+    "Await query_coro, recording in METRICS how long it took and what it returned."
+    start = time.time()
+    result = await query_coro
+    labels = {
+        "endpoint": endpoint_name(prepared["endpoint"]),
+        "backend": "local" if prepared["endpoint"] == "__local__" else "remote",
+    }
+    if "error" in result:
+        METRICS.inc(
+            "shmarql_query_errors_total", status=result.get("status", 500), **labels
+        )
+        return result
+    METRICS.observe(
+        "shmarql_query_duration_seconds", time.time() - start, **labels, format=format
+    )
+    if "results" in result:
+        METRICS.observe(
+            "shmarql_query_result_rows",
+            len(result["results"].get("bindings", [])),
+            endpoint=labels["endpoint"],
+        )
+    return result
+
+
+def collect_metrics(metrics):
+    "Readings of what this module and the LOCAL_CACHE count themselves."
+    metrics.set("shmarql_backend_queries_total", backend_queries)
+    metrics.set("shmarql_local_queries_pending", local_queries_pending)
+    metrics.set("shmarql_data_quads", DATA_QUADS)
+    stats = LOCAL_CACHE.stats()
+    metrics.set(
+        "shmarql_cache_requests_total", stats["hits"], cache="local", result="hit"
+    )
+    metrics.set(
+        "shmarql_cache_requests_total", stats["misses"], cache="local", result="miss"
+    )
+    metrics.set("shmarql_cache_evictions_total", stats["evictions"])
+    metrics.set("shmarql_cache_bytes", stats["bytes"])
+
+
+METRICS.collectors.append(collect_metrics)
+
+
+def truncate_results(result: dict) -> dict:
+    "Cut the bindings of SPARQL JSON results off at MAX_RESULT_ROWS."
+    bindings = result.get("results", {}).get("bindings")
+    if MAX_RESULT_ROWS and bindings and len(bindings) > MAX_RESULT_ROWS:
+        result["results"]["bindings"] = bindings[:MAX_RESULT_ROWS]
+        result["truncated"] = True
+    return result
+
+
+async def run_query(prepared: dict) -> dict:
+    query = prepared["query"]
+    to_use = prepared["endpoint"]
+    shmarql_settings = prepared["shmarql_settings"]
+    count_backend_query()
 
     time_start = time.time()
     result = {}
     if to_use == "__local__":
         try:
-            qquery = PREFIXES_SNIPPET + "\n" + query
-            r = GRAPH.query(qquery, use_default_graph_as_union=True)
-            result = OxigraphSerialization(r).json()
+            result = await do_local_query(PREFIXES_SNIPPET + "\n" + query)
         except Exception as e:
             return {"error": str(e)}
+        if result and "error" in result:
+            return result
     else:
-        if rewritten.get("query_type") == "construct":
+        if prepared["query_type"] == "construct":
             accept_header = "text/turtle"
         else:
             accept_header = "application/sparql-results+json"
         headers = {
             "Accept": accept_header,
-            "User-Agent": "SHMARQL/2024 (https://shmarql.com/ ep@epoz.org)",
         }
 
         data = {
             "query": PREFIXES_SNIPPET + "\n" + query,
         }
         try:
-            r = httpx.post(to_use, data=data, headers=headers, timeout=180)
+            r = await asyncio.wait_for(
+                http_client(to_use).post(to_use, data=data, headers=headers),
+                QUERY_TIMEOUT or None,
+            )
             if r.status_code == 200:
+                if MAX_RESULT_BYTES and len(r.content) > MAX_RESULT_BYTES:
+                    return too_large()
                 try:
-                    result = r.json()
+                    result = truncate_results(r.json())
                 except json.JSONDecodeError:
                     result = {"data": r.content.decode("utf8")}
             elif r.status_code == 500:
                 return {"error": r.text}
-        except:
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            log.debug(f"Query to {to_use} timed out")
+            return timed_out()
+        except Exception:
             log.exception(f"Problem with {to_use}")
             return {"error": "Exception raised querying endpoint"}
 
     time_end = time.time()
     duration = time_end - time_start
 
-    # get the endpoint name from the to_use URL
-    endpoint_name = "default"
-    for k, v in ENDPOINTS.items():
-        if v == to_use:
-            endpoint_name = k
-
     if result:
         try:
             result["prefixes"] = parse_prefixes(query)
         except:
             log.error("Error parsing prefixes from query")
         result["duration"] = duration
-        result["endpoint_name"] = endpoint_name
+        result["endpoint_name"] = endpoint_name(to_use)
         result["endpoint"] = to_use
         result["shmarql_settings"] = shmarql_settings
         result["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        result["cached_at"] = time.time()
 
+        dumped = json.dumps(result)
+        LOCAL_CACHE.set(hash_query(query, to_use), result, len(dumped))
         if config.redis_client:
-            dumped = json.dumps(result)
-
             await config.redis_client.set(
                 hash_query(query, to_use),
                 dumped,
-                60 * 60 * 24 * 3,
-            )  # 3 days expiry
+                CACHE_TTL,
+            )
 
         return result
     else:
         return {"error": r.text, "status": r.status_code}
 
 
+async def do_query_serialized(query: str, format: str) -> dict:
+    """Like do_query, but returns the results as bytes in "body", serialized into
+    format (see RESULTS_FORMATS) by pyoxigraph without building Python objects for
+    every term. This is what API clients get, the dict that do_query returns is
+    only needed to render the HTML UI."""
+    return await admitted(find_query_serialized(query, format))
+
+
+async def find_query_serialized(query: str, format: str) -> dict:
+    prepared = prepare_query(query)
+    if "error" in prepared:
+        return prepared
+    cache_key = hash_query(prepared["query"], prepared["endpoint"], format)
+
+    if "nocache" in prepared["shmarql_settings"]:
+        return await measured(
+            prepared, format, run_query_serialized(prepared, format, cache_key)
+        )
+    compute = lambda: measured(
+        prepared, format, run_query_serialized(prepared, format, cache_key)
+    )
+    cached = lambda: cached_body(cache_key)
+    cached_result = await cached()
+    if cached_result:
+        refresh_if_stale(cache_key, cached_result, compute, cached)
+        return cached_result
+    return await coalesce(cache_key, compute, cached)
+
+
+async def run_query_serialized(prepared: dict, format: str, cache_key: str) -> dict:
+    query = prepared["query"]
+    to_use = prepared["endpoint"]
+    construct = prepared["query_type"] in ("construct", "describe")
+    count_backend_query()
+
+    cancelled = threading.Event()
+    chunks = []
+
+    def collect(chunk: bytes):
+        if cancelled.is_set():
+            raise QueryCancelled()
+        chunks.append(chunk)
+
+    writer = ChunkWriter(collect, max_bytes=MAX_RESULT_BYTES)
+    time_start = time.time()
+    if to_use == "__local__":
+        future = submit_local_query(
+            serialize_local_query, PREFIXES_SNIPPET + "\n" + query, format, writer
+        )
+        if future is None:
+            return {
+                "error": "Too many queries in progress, try again later",
+                "status": 503,
+            }
+        result = await await_local_query(future, cancelled)
+    else:
+        headers = {
+            "Accept": (
+                "text/turtle" if construct else "application/sparql-results+json"
+            ),
+        }
+        data = {
+            "query": PREFIXES_SNIPPET + "\n" + query,
+        }
+        try:
+            r = await asyncio.wait_for(
+                http_client(to_use).post(to_use, data=data, headers=headers),
+                QUERY_TIMEOUT or None,
+            )
+        except (asyncio.TimeoutError, httpx.TimeoutException):
+            log.debug(f"Query to {to_use} timed out")
+            return timed_out()
+        except Exception:
+            log.exception(f"Problem with {to_use}")
+            return {"error": "Exception raised querying endpoint"}
+        if r.status_code != 200:
+            return {"error": r.text, "status": r.status_code}
+        if MAX_RESULT_BYTES and len(r.content) > MAX_RESULT_BYTES:
+            return too_large()
+        if format == ("turtle" if construct else "json"):
+            # What the endpoint sent is already what the client asked for
+            chunks.append(r.content)
+            result = {"content_type": RESULTS_FORMATS[format][1]}
+        else:
+            try:
+                result = await asyncio.get_running_loop().run_in_executor(
+                    None, convert_remote_results, r.content, construct, format, writer
+                )
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+    if "error" in result:
+        return result
+
+    result["body"] = b"".join(chunks)
+    result["duration"] = time.time() - time_start
+    result["endpoint_name"] = endpoint_name(to_use)
+    result["timestamp"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    caching = config.redis_client or LOCAL_CACHE.max_bytes > 0
+    if caching and not "nocache" in prepared["shmarql_settings"]:
+        # Compressing once here means cache hits never have to
+        result["body"] = gzip.compress(result["body"], CACHE_COMPRESSION_LEVEL)
+        result["content_encoding"] = "gzip"
+        result["cached_at"] = time.time()
+        await cache_body(cache_key, result)
+    return result
+
+
+def use_store(store: px.Store, quads: int, version: str):
+    global GRAPH, DATA_QUADS, DATA_VERSION
+    GRAPH, DATA_QUADS, DATA_VERSION = store, quads, version
+    log.debug(f"Graph haz {quads} triples, data version {version}")
+
+
+def readiness() -> dict:
+    "Whether this process can answer queries, for the readiness endpoint."
+    if ENDPOINT or ENDPOINTS:
+        return {"ready": True}
+    if GRAPH is None:
+        return {"ready": False}
+    ready = {"ready": True, "quads": DATA_QUADS, "version": DATA_VERSION}
+    if BIKIDATA_DB:
+        ready["fts"] = fts_state()
+    return ready
+
+
+def load_store(data_load_paths: list, store_path: str):
+    """Bring the store at store_path up to date with data_load_paths and mark it as
+    ready. Only to be called while holding the lock from lock_store. The store is
+    closed again afterwards, from then on everyone opens it read-only. If nothing
+    changed the ready marker is left as it is, so nobody reopens the store."""
+    ready = read_ready(store_path)
+    changed = False
+
+    def changing():
+        nonlocal changed
+        changed = True
+        clear_ready(store_path)
+
+    store = px.Store(store_path)
+    manifest, progress = load_sources(
+        store, data_load_paths, store_path, changing=changing
+    )
+    quads = len(store)
+    if progress:
+        progress.report(quads)
+    store.flush()
+    del store
+    version = data_version(quads, manifest, store_path)
+    if not changed and ready and ready["version"] == version:
+        log.debug(f"Store at {store_path} is up to date")
+        return ready
+    ready = {
+        "quads": quads,
+        "version": version,
+        "loaded_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    write_ready(store_path, ready)
+    return ready
+
+
+def open_store(store_path: str, ready: dict = None):
+    if STORE_VERSION and (ready or {}).get("version") != STORE_VERSION:
+        log.error(
+            f"Store at {store_path} has data version {(ready or {}).get('version')},"
+            f" expected STORE_VERSION {STORE_VERSION}, not using it"
+        )
+        return
+    if not ready and not STORE_EXTERNAL:
+        log.warning(
+            f"Store at {store_path} is not marked as loaded, waiting for it. Set"
+            " STORE_EXTERNAL for a store that was not built by shmarql."
+        )
+        return
+    store = px.Store.read_only(store_path)
+    if ready:
+        use_store(store, ready["quads"], ready["version"])
+    else:
+        quads = len(store)
+        use_store(store, quads, data_version(quads, None, store_path))
+
+
+def watch_store(store_path: str, ready: dict):
+    """Re-open the store read-only whenever a loader marks it as (re)loaded. This
+    runs in a thread in every process, also to pick up the store when it is first
+    ready in the processes that did not do the loading."""
+    while True:
+        time.sleep(STORE_POLL_INTERVAL)
+        new_ready = read_ready(store_path)
+        if new_ready and new_ready != ready:
+            log.debug(f"Store at {store_path} was loaded, opening it")
+            try:
+                open_store(store_path, new_ready)
+                ready = new_ready
+            except OSError:
+                log.exception(f"Problem opening store at {store_path}")
+
+
 def initialize_graph(data_load_paths: list, store_path: str = None) -> px.Store:
+    """Load the data and install it as the GRAPH that local queries run against.
+
+    Without a store_path, every process loads its own in-memory store. With one,
+    the first process to get the lock on the store loads it, the others wait for
+    it to be marked ready and answer queries with a 503 until then."""
     log.debug(f"Initialize graph with configs: {data_load_paths} and {store_path}")
-    store_primary = True
-    if store_path:
-        log.debug(f"Opening store from {store_path}")
+    if not store_path:
+        store = px.Store()
+        manifest, progress = load_sources(store, data_load_paths or [])
+        quads = len(store)
+        if progress:
+            progress.report(quads)
+        use_store(store, quads, data_version(quads, manifest))
         if data_load_paths:
-            # If there are multiple workers trying to load at the same time,
-            # contention for the lock will happen.
-            # Do a short wait to stagger start times and let one win, the rest will lock and open read_only
-            time.sleep(random.random() / 2)
+            start_index_update(store, manifest)
+        return GRAPH
+
+    ready = None
+    if data_load_paths:
+        lock = lock_store(store_path)
+        if lock:
+            log.debug("This process won the loading contention")
             try:
-                GRAPH = px.Store(store_path)
-                log.debug("This process won the loading contention")
-            except OSError:
-                log.debug("Secondary, opening store read-only")
-                GRAPH = px.Store.secondary(store_path)
-                store_primary = False
+                ready = read_ready(store_path)
+                checked_at = (read_manifest(store_path) or {}).get("checked_at", 0)
+                if ready and checked_at > STARTED_AT:
+                    # Another worker that started at the same time beat us to it
+                    log.debug(f"Store at {store_path} was loaded since this started")
+                else:
+                    ready = load_store(data_load_paths, store_path)
+            finally:
+                lock.close()
+            open_store(store_path, ready)
+            if GRAPH is not None:
+                start_index_update(GRAPH, read_manifest(store_path))
         else:
-            log.debug("Opening store read-only")
-            GRAPH = px.Store.read_only(store_path)
+            log.debug("Another process is loading the store, waiting for it")
     else:
-        GRAPH = px.Store()
-
-    if len(GRAPH) < 1 and data_load_paths and store_primary:
-        for data_load_path in data_load_paths:
-            if data_load_path.startswith("http://") or data_load_path.startswith(
-                "https://"
-            ):
-                log.debug(f"Downloading {data_load_path}")
-                # Try downloading this file and parsing it as a string
-                start_download = time.time()
-                r = httpx.get(data_load_path, follow_redirects=True, timeout=180)
-                if r.status_code == 200:
-                    log.debug(
-                        f"Downloading {data_load_path} took {int(time.time() - start_download)} seconds"
-                    )
-                    d = r.content
-                    # Try and guess content type from extention, default is turtle
-                    # if .rdf or .nt use on of those
-                    if (
-                        data_load_path.endswith(".rdf")
-                        or data_load_path.endswith(".xml")
-                        or data_load_path.endswith(".owl")
-                    ):
-                        GRAPH.bulk_load(r.content, "application/rdf+xml", lenient=True)
-                    elif data_load_path.endswith(".nt") or data_load_path.endswith(
-                        ".nt.gz"
-                    ):
-                        GRAPH.bulk_load(
-                            r.content, "application/n-triples", lenient=True
-                        )
-                    else:
-                        GRAPH.bulk_load(r.content, "text/turtle", lenient=True)
-            else:
-                if load_file_to_graph(GRAPH, data_load_path):
-                    continue
-                for dirpath, _, filenames in os.walk(data_load_path):
-                    for filename in filenames:
-                        try:
-                            filepath = os.path.join(dirpath, filename)
-                            load_file_to_graph(GRAPH, filepath)
-                        except SyntaxError:
-                            log.error(f"Failed to parse {filepath}")
-
-    log.debug(f"Graph haz {len(GRAPH)} triples")
-
-    if store_primary and BIKIDATA_DB and not os.path.exists(BIKIDATA_DB):
-        r = fizzysearch.build_from_iterator(string_iterator(GRAPH))
-        log.debug(
-            f"NEW bikidata built at {BIKIDATA_DB} with {r.get('count', '?')} literals"
-        )
-
+        ready = read_ready(store_path)
+        open_store(store_path, ready)
+    threading.Thread(target=watch_store, args=(store_path, ready), daemon=True).start()
     return GRAPH
 
 
-def load_file_to_graph(graph: px.Store, filepath: str) -> bool:
-    was_file = False
-    try:
-        filename = os.path.basename(filepath)
-        if filename.endswith(".gz"):
-            filepath = gzip.open(filepath)
-            filename = filename[:-3]
-        else:
-            filepath = open(filepath, "rb")
-        if filename.lower().endswith(".ttl"):
-            log.debug(f"Parsing {filepath} as ttl")
-            graph.bulk_load(filepath, px.RdfFormat.TURTLE, lenient=True)
-            was_file = True
-        elif filename.lower().endswith(".nt"):
-            log.debug(f"Parsing {filepath} as nt")
-            graph.bulk_load(filepath, px.RdfFormat.N_TRIPLES, lenient=True)
-            was_file = True
-        elif filename.lower().endswith(".trig"):
-            log.debug(f"Parsing {filepath} as trig")
-            graph.bulk_load(filepath, px.RdfFormat.TRIG, lenient=True)
-            was_file = True
-    except Exception as e:
-        log.debug(f"{filepath} exception {e}")
-    return was_file
+def data_version(quads: int, manifest: dict = None, store_path: str = None) -> str:
+    """A fingerprint of the loaded data, from the number of quads and what the load
+    manifest recorded of every source: the hash of its contents, and for remote
+    ones their ETag and Last-Modified. A dump that is refreshed at the same URL
+    gets a new version. For a store without a manifest, the path, size and
+    modification time of the files in the store directory are used instead."""
+    fingerprint = hashlib.md5(f"{quads} {store_path}".encode("utf8"))
+    if manifest is not None:
+        for source, entry in sorted(manifest["sources"].items()):
+            fingerprint.update(
+                f"{source} {entry.get('hash')} {entry.get('etag')}"
+                f" {entry.get('last_modified')}".encode("utf8")
+            )
+        return fingerprint.hexdigest()[:12]
+    for path in sorted(expand_sources([store_path] if store_path else [])):
+        try:
+            stat = os.stat(path)
+            fingerprint.update(
+                f"{path} {stat.st_size} {stat.st_mtime_ns}".encode("utf8")
+            )
+        except OSError:
+            fingerprint.update(path.encode("utf8"))
+    return fingerprint.hexdigest()[:12]
 
 
 if not (ENDPOINT or len(ENDPOINTS) > 0):
     log.debug("No ENDPOINT or ENDPOINTS defined, using local graph")
-    GRAPH = initialize_graph(DATA_LOAD_PATHS, STORE_PATH)
+    initialize_graph(DATA_LOAD_PATHS, STORE_PATH)
@@ -0,0 +1,71 @@
+import gzip, os
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from shmarql import assets
+from shmarql.assets import StaticFiles
+
+
+def client(files: StaticFiles) -> TestClient:
+    app = FastAPI()
+
+    @app.get("/{name:path}")
+    def get(request: Request, name: str):
+        return files.response(request, name)
+
+    return TestClient(app)
+
+
+def test_symlinks(tmp_path):
+    real = tmp_path / "real"
+    real.mkdir()
+    (real / "a.txt").write_text("linked")
+    root = tmp_path / "root"
+    root.mkdir()
+    os.symlink(real, root / "sub")
+    os.symlink(tmp_path / "missing", root / "dangling")
+    files = StaticFiles(str(root))
+    assert sorted(files.files) == ["sub/a.txt"]
+    assert client(files).get("/sub/a.txt").text == "linked"
+
+
+def test_changed_file(tmp_path):
+    path = tmp_path / "a.txt"
+    path.write_text("one")
+    c = client(StaticFiles(str(tmp_path), reload=True))
+    first = c.get("/a.txt")
+    path.write_text("three")
+    second = c.get("/a.txt")
+    assert second.text == "three"
+    assert second.headers["content-length"] == "5"
+    assert second.headers["etag"] != first.headers["etag"]
+
+
+def test_no_disk_access(tmp_path, monkeypatch):
+    (tmp_path / "a.txt").write_text("one")
+    hashed = []
+    monkeypatch.setattr(assets, "file_hash", lambda path: hashed.append(path) or "1")
+    files = StaticFiles(str(tmp_path), reload=False)
+    # Hashed on the first request, not at startup
+    assert hashed == []
+    c = client(files)
+    monkeypatch.setattr(assets.os, "stat", None)
+    assert c.get("/a.txt").headers["etag"] == '"1"'
+    assert c.get("/a.txt").text == "one"
+    assert len(hashed) == 1
+
+
+def test_accept_encoding(tmp_path):
+    (tmp_path / "a.txt").write_text("one" * 100)
+    (tmp_path / "a.txt.gz").write_bytes(gzip.compress(b"one" * 100))
+    c = client(StaticFiles(str(tmp_path)))
+
+    def encoding(accept: str) -> str:
+        headers = {"Accept-Encoding": accept}
+        return c.get("/a.txt", headers=headers).headers.get("content-encoding")
+
+    assert encoding("gzip, deflate") == "gzip"
+    assert encoding("gzip;q=0") is None
+    assert encoding("gzip; q=0.0, br") is None
+    assert encoding("*") == "gzip"
+    assert encoding("*;q=0, identity") is None
+    assert encoding("") is None
@@ -0,0 +1,39 @@
+import pandas as pd
+from shmarql import charts
+
+
+def points(n: int) -> pd.DataFrame:
+    # n points, in two clusters far apart
+    return pd.DataFrame(
+        {
+            "geo": [
+                f"POINT({4.9 + i % 2 * 100 + i * 1e-6} {52.3 + i * 1e-6})"
+                for i in range(n)
+            ]
+        }
+    )
+
+
+def test_parse_points():
+    column = pd.Series(["POINT(4.9 52.3)", "<http://crs> Point(1 2)", "nope", None])
+    parsed = charts.parse_points(column)
+    assert parsed["lon"].tolist()[:2] == [4.9, 1]
+    assert parsed["lat"].tolist()[:2] == [52.3, 2]
+    assert parsed.iloc[2:].isna().all().all()
+
+
+def test_bin_points():
+    data = charts.parse_points(points(1000)["geo"])
+    binned = charts.bin_points(data, 3)
+    assert len(binned) == 2
+    assert binned["count"].tolist() == [500, 500]
+
+
+def test_map_binning(monkeypatch):
+    # Off by default, every point is drawn
+    assert len(charts.do_mapchart({}, points(100)).data[0].lat) == 100
+    binned = charts.do_mapchart({"aggregate": ["tiles"]}, points(100))
+    assert len(binned.data[0].lat) == 2
+    monkeypatch.setattr(charts, "MAP_MAX_POINTS", 50)
+    assert len(charts.do_mapchart({}, points(100)).data[0].lat) == 2
+    assert len(charts.do_mapchart({}, points(50)).data[0].lat) == 50
@@ -0,0 +1,36 @@
+import threading, time
+import pytest
+from click.testing import CliRunner
+from shmarql import fts
+
+# The CLI also brings in the admin and mkdocs commands, and what they need
+cli = pytest.importorskip("shmarql.__main__")
+
+
+def build(tmp_path, monkeypatch, update_index) -> object:
+    data = tmp_path / "data.nt"
+    data.write_text('<http://example.org/a> <http://example.org/p> "one" .\n')
+    monkeypatch.setattr(cli, "BIKIDATA_DB", str(tmp_path / "index.db"))
+    monkeypatch.setattr(cli, "update_index", update_index)
+    args = ["--output", str(tmp_path / "store"), str(data)]
+    return CliRunner().invoke(cli.build_store, args)
+
+
+def test_build_store_waits_for_the_index(tmp_path, monkeypatch):
+    done = []
+    background = threading.Thread(target=lambda: time.sleep(0.2) or done.append(1))
+    background.start()
+    monkeypatch.setattr(fts, "INDEX_UPDATE", background)
+
+    def update_index(store, graphs, db_path, wait):
+        assert done and wait
+        return True
+
+    assert build(tmp_path, monkeypatch, update_index).exit_code == 0
+
+
+def test_build_store_fails_without_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(fts, "INDEX_UPDATE", None)
+    result = build(tmp_path, monkeypatch, lambda *args, **kwargs: False)
+    assert result.exit_code == 1
+    assert "index" in result.output
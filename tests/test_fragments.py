@@ -0,0 +1,28 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from shmarql import fragments
+
+
+def test_pages_are_posted(monkeypatch):
+    monkeypatch.setattr(fragments, "TABLE_PAGE_SIZE", 2)
+    query = "SELECT ?s WHERE { ?s ?p ?o }"
+    rows = [{"s": {"type": "literal", "value": f"row {i}"}} for i in range(5)]
+    results = {"head": {"vars": ["s"]}, "results": {"bindings": rows}}
+
+    async def do_query(q):
+        assert q == query
+        return results
+
+    monkeypatch.setattr(fragments, "do_query", do_query)
+    app = FastAPI()
+    fragments.rt.to_app(app)
+    client = TestClient(app)
+
+    html = client.post(
+        "/shmarql/fragments/sparql", data={"query": query, "page": "2"}
+    ).text
+    assert "row 2" in html and "row 4" not in html
+    # The links only carry the page, the query is posted from the pager
+    assert 'data-page="1"' in html and 'data-page="3"' in html
+    assert "fragments/sparql?" not in html
+    assert 'data-query="SELECT ?s WHERE { ?s ?p ?o }"' in html
@@ -0,0 +1,36 @@
+import pyoxigraph as px
+from shmarql import fts
+
+
+def test_failed_update_is_reported(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "index.db")
+    monkeypatch.setattr(fts, "BIKIDATA_DB", db_path)
+    store = px.Store()
+
+    def broken(store, graphs, db_path):
+        raise IOError("Could not download the fts extension")
+
+    monkeypatch.setattr(fts, "build_index", broken)
+    assert not fts.update_index(store, {}, db_path)
+    assert fts.fts_state() == "failed"
+    assert "fts extension" in fts.read_failed(db_path)["error"]
+
+    monkeypatch.setattr(fts, "build_index", lambda store, graphs, db_path: None)
+    assert fts.update_index(store, {}, db_path)
+    assert fts.fts_state() == "ready"
+
+    lock = fts.lock_index(db_path)
+    assert fts.fts_state() == "warming"
+    assert not fts.update_index(store, {}, db_path)
+    lock.close()
+
+
+def test_hash_ntriples(tmp_path):
+    path = tmp_path / "graph.nt"
+    path.write_text('<http://example.org/a> <http://example.org/p> "one" .\n')
+    fts.hash_ntriples(str(path), "urn:g")
+    s, p, o, g = (tmp_path / "graph.nt.triples").read_text().split()
+    assert s == fts.H("<http://example.org/a>")
+    assert o == fts.H('"one"')
+    assert g == fts.H("urn:g")
+    assert f'{o}\t|\t"one"' in (tmp_path / "graph.nt.maps").read_text()
@@ -0,0 +1,113 @@
+import asyncio
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+from shmarql import config, limits
+from shmarql.limits import Limiter
+
+
+class FakeRedis:
+    "Just the commands the limiter uses, failing pipelines if told to."
+
+    def __init__(self):
+        self.values = {}
+        self.failing = False
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    async def decr(self, key):
+        self.values[key] = self.values.get(key, 0) - 1
+
+
+class FakePipeline:
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def incr(self, key):
+        self.commands.append(key)
+
+    def expire(self, key, seconds):
+        self.commands.append(None)
+
+    async def execute(self):
+        if self.redis.failing:
+            raise ConnectionError("Redis is gone")
+        results = []
+        for key in self.commands:
+            if key is not None:
+                self.redis.values[key] = self.redis.values.get(key, 0) + 1
+            results.append(self.redis.values.get(key, True))
+        return results
+
+
+def client_ids(headers: list, trusted: int, monkeypatch) -> list:
+    monkeypatch.setattr(limits, "CLIENT_IP_HEADER", "X-Forwarded-For")
+    monkeypatch.setattr(limits, "TRUSTED_PROXIES", trusted)
+    app = FastAPI()
+
+    @app.get("/")
+    def get(request: Request):
+        return limits.client_id(request)
+
+    client = TestClient(app)
+    return [client.get("/", headers={"X-Forwarded-For": h}).json() for h in headers]
+
+
+def test_client_id_ignores_what_the_client_sends(monkeypatch):
+    headers = ["10.0.0.1", "1.2.3.4, 10.0.0.1", "5.6.7.8, 10.0.0.1"]
+    assert client_ids(headers, 1, monkeypatch) == ["ip:10.0.0.1"] * 3
+    headers = ["1.2.3.4, 10.0.0.1, 192.168.0.1", "10.0.0.1"]
+    assert client_ids(headers, 2, monkeypatch) == ["ip:10.0.0.1"] * 2
+
+
+def test_admit_and_release_locally(monkeypatch):
+    monkeypatch.setattr(config, "redis_client", None)
+    monkeypatch.setattr(limits, "RATE_LIMIT_PER_MINUTE", 3)
+    monkeypatch.setattr(limits, "MAX_CONCURRENT_QUERIES", 1)
+    limiter = Limiter()
+
+    async def run():
+        rejected, counted = await limiter.admit("a")
+        assert rejected is None and counted == "local"
+        busy, _ = await limiter.admit("a")
+        assert busy["status"] == 429
+        assert (await limiter.admit("b"))[0] is None
+        await limiter.release("a", counted)
+        assert "a" not in limiter.running
+        rejected, counted = await limiter.admit("a")
+        assert rejected is None
+        await limiter.release("a", counted)
+        over, _ = await limiter.admit("a")
+        assert over["status"] == 429 and "a minute" in over["error"]
+
+    asyncio.run(run())
+
+
+def test_release_where_admitted(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(config, "redis_client", redis)
+    monkeypatch.setattr(limits, "MAX_CONCURRENT_QUERIES", 5)
+    limiter = Limiter()
+
+    async def run():
+        redis.failing = True
+        _, local = await limiter.admit("a")
+        redis.failing = False
+        _, remote = await limiter.admit("a")
+        assert (local, remote) == ("local", "redis")
+        assert redis.values["running:a"] == 1
+        await limiter.release("a", remote)
+        assert redis.values["running:a"] == 0
+        assert limiter.running == {"a": 1}
+        await limiter.release("a", local)
+        assert limiter.running == {}
+        assert redis.values["running:a"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,91 @@
+import gzip, http.server, threading
+import pyoxigraph as px
+from shmarql.loader import load_sources
+
+SHARED = '<http://example.org/a> <http://example.org/p> "shared" .\n'
+
+
+def write_overlapping(tmp_path):
+    data = tmp_path / "data"
+    data.mkdir()
+    (data / "one.nt").write_text(
+        SHARED + '<http://example.org/a> <http://example.org/p> "one" .\n'
+    )
+    (data / "two.nt").write_text(
+        SHARED
+        + '<http://example.org/b> <http://example.org/p> "two" .\n'
+        + '<http://example.org/c> <http://example.org/p> "two" .\n'
+    )
+    return data
+
+
+def count(store: px.Store) -> int:
+    r = store.query(
+        "SELECT (COUNT(*) AS ?n) WHERE { ?s ?p ?o }", use_default_graph_as_union=True
+    )
+    return int(next(r)["n"].value)
+
+
+def test_overlapping_sources_in_memory(tmp_path):
+    store = px.Store()
+    load_sources(store, [str(write_overlapping(tmp_path))])
+    assert count(store) == 4
+    assert list(store.named_graphs()) == []
+
+
+def test_overlapping_sources_persistent(tmp_path):
+    data = write_overlapping(tmp_path)
+    store_path = tmp_path / "store"
+    store = px.Store(str(store_path))
+    manifest, progress = load_sources(store, [str(data)], str(store_path))
+    assert progress.files_done == 2
+    assert count(store) == 4
+    assert list(store.named_graphs()) == []
+    assert sorted(manifest["sources"]) == [str(data / "one.nt"), str(data / "two.nt")]
+
+
+def test_reload_persistent(tmp_path):
+    data = write_overlapping(tmp_path)
+    store_path = tmp_path / "store"
+    store = px.Store(str(store_path))
+    load_sources(store, [str(data)], str(store_path))
+    # Nothing changed, nothing is loaded
+    _, progress = load_sources(store, [str(data)], str(store_path))
+    assert progress is None
+    (data / "three.nt").write_text(SHARED)
+    _, progress = load_sources(store, [str(data)], str(store_path))
+    assert progress.files_total == 1
+    assert count(store) == 4
+    # The shared triple stays, as it is in the other file too
+    (data / "one.nt").unlink()
+    _, progress = load_sources(store, [str(data)], str(store_path))
+    assert progress.files_total == 2
+    assert count(store) == 3
+
+
+def test_gzip_encoded_download():
+    turtle = b"<http://example.org/a> <http://example.org/p> 'remote' .\n"
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = gzip.compress(turtle)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/turtle")
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        store = px.Store()
+        url = f"http://127.0.0.1:{server.server_port}/data.ttl"
+        manifest, _ = load_sources(store, [url])
+    finally:
+        server.shutdown()
+    assert url in manifest["sources"]
+    assert len(store) == 1
@@ -0,0 +1,66 @@
+import asyncio, json, time
+from shmarql import config
+from shmarql.metrics import Metrics, exposition
+from shmarql.config import METRICS_KEY
+
+
+class FakeRedis:
+    "Just the hash commands that metrics uses."
+
+    def __init__(self):
+        self.hashes = {}
+
+    async def hset(self, key, field, value):
+        self.hashes.setdefault(key, {})[field.encode()] = value.encode()
+
+    async def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    async def hdel(self, key, *fields):
+        for field in fields:
+            self.hashes[key].pop(field, None)
+
+
+def test_collect_all_workers(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(config, "redis_client", redis)
+    one, two = Metrics(), Metrics()
+    one.inc("shmarql_rejected_queries_total", reason="rate")
+    two.inc("shmarql_rejected_queries_total", reason="rate")
+    one.set("shmarql_data_quads", 5)
+    two.set("shmarql_data_quads", 7)
+    asyncio.run(two.publish("two"))
+    # A worker that stopped long ago
+    stale = {"at": time.time() - 3600, "metrics": two.snapshot()}
+    redis.hashes[METRICS_KEY][b"gone"] = json.dumps(stale).encode()
+    redis.hashes["metrics:other site"] = dict(redis.hashes[METRICS_KEY])
+
+    text = exposition(asyncio.run(one.collect_all("one")))
+    assert 'shmarql_rejected_queries_total{reason="rate"} 2' in text
+    assert "shmarql_data_quads 7" in text
+    assert sorted(redis.hashes[METRICS_KEY]) == [b"one", b"two"]
+
+
+def test_publisher_stops_on_shutdown(monkeypatch):
+    from shmarql import main
+
+    async def run():
+        publisher = asyncio.create_task(Metrics().keep_publishing("one"))
+        monkeypatch.setattr(main.app.state, "metrics_publisher", publisher, False)
+        await asyncio.sleep(0)
+        await main.shutdown_event()
+        assert publisher.cancelled()
+
+    asyncio.run(run())
+
+
+def test_metrics_only_when_enabled(monkeypatch):
+    from fastapi.testclient import TestClient
+    from shmarql import main
+
+    monkeypatch.setattr(config, "redis_client", None)
+    client = TestClient(main.app)
+    monkeypatch.setattr(main, "METRICS_ENABLED", False)
+    assert client.get("/metrics").status_code == 404
+    monkeypatch.setattr(main, "METRICS_ENABLED", True)
+    assert "shmarql_" in client.get("/metrics").text
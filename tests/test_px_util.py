@@ -0,0 +1,16 @@
+import pandas as pd
+from shmarql import px_util
+
+
+def test_prefix_column(monkeypatch):
+    monkeypatch.setattr(px_util, "PREFIXES", {"http://example.org/item_": "item:"})
+    monkeypatch.setattr(px_util, "PREFIX_RESOLVERS", {})
+    column = pd.Series(
+        ["http://example.org/item_1", "http://example.org/item_1", None, "other"],
+        dtype=object,
+    )
+    prefixed = px_util.prefix_column(column)
+    assert prefixed.tolist()[:2] == ["item:1", "item:1"]
+    assert prefixed.isna().tolist() == [False, False, True, False]
+    assert prefixed[3] == "other"
+    assert prefixed[0] == px_util.do_prefixes(column[0])
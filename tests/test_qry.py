@@ -0,0 +1,255 @@
+import asyncio, json, threading, time
+import pytest
+import pyoxigraph as px
+from shmarql import config, limits, qry
+from shmarql.loader import read_ready
+from shmarql.px_util import OxigraphSerialization, QueryCancelled
+from shmarql.qry import data_version
+
+
+def test_data_version_follows_remote_refresh():
+    url = "https://example.org/dump.ttl"
+    before = {"sources": {url: {"graph": url, "etag": '"1"', "hash": "aa"}}}
+    after = {"sources": {url: {"graph": url, "etag": '"2"', "hash": "bb"}}}
+    assert data_version(10, before) == data_version(10, before)
+    assert data_version(10, before) != data_version(10, after)
+
+
+class FakeRedis:
+    "Just the string commands that locked_compute uses, without expiry."
+
+    def __init__(self):
+        self.values = {}
+
+    async def set(self, key, value, nx=False, px=None, ex=None):
+        if nx and key in self.values:
+            return None
+        self.values[key] = value.encode() if isinstance(value, str) else value
+        return True
+
+    async def get(self, key):
+        return self.values.get(key)
+
+    async def exists(self, key):
+        return int(key in self.values)
+
+    async def delete(self, key):
+        self.values.pop(key, None)
+
+
+def test_coalesce_runs_once(monkeypatch):
+    monkeypatch.setattr(config, "redis_client", None)
+    runs = []
+
+    async def compute():
+        runs.append(1)
+        await asyncio.sleep(0.05)
+        return {"results": 1}
+
+    async def run():
+        return await asyncio.gather(
+            *[qry.coalesce("key", compute, None) for _ in range(5)]
+        )
+
+    assert asyncio.run(run()) == [{"results": 1}] * 5
+    assert len(runs) == 1
+
+
+def test_waiters_share_the_outcome(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(config, "redis_client", redis)
+    monkeypatch.setattr(qry, "CACHE_LOCK_POLL", 0.01)
+    lookups = []
+
+    async def compute():
+        raise AssertionError("Computed by the other worker already")
+
+    async def cached():
+        lookups.append(1)
+
+    async def other_worker(error: dict):
+        await redis.set("lock:key", "other")
+        await asyncio.sleep(0.1)
+        await redis.set("error:key", json.dumps(error))
+        await redis.delete("lock:key")
+
+    async def run():
+        error = {"error": "Endpoint timed out", "status": 504}
+        _, result = await asyncio.gather(
+            other_worker(error), qry.locked_compute("key", compute, cached)
+        )
+        return result
+
+    assert asyncio.run(run())["status"] == 504
+    # The cache is only looked at once the lock is gone
+    assert len(lookups) == 1
+
+
+def test_waiters_give_up(monkeypatch):
+    redis = FakeRedis()
+    redis.values["lock:key"] = b"other"
+    monkeypatch.setattr(config, "redis_client", redis)
+    monkeypatch.setattr(qry, "CACHE_LOCK_POLL", 0.01)
+    monkeypatch.setattr(qry, "QUERY_TIMEOUT", 0.1)
+
+    async def compute():
+        raise AssertionError("Still locked by the other worker")
+
+    result = asyncio.run(qry.locked_compute("key", compute, None))
+    assert result["status"] == 504
+
+
+def test_errors_are_kept_for_waiters(monkeypatch):
+    redis = FakeRedis()
+    monkeypatch.setattr(config, "redis_client", redis)
+
+    async def compute():
+        return {"error": "Syntax error", "status": 400, "traceback": object()}
+
+    result = asyncio.run(qry.locked_compute("key", compute, None))
+    assert result["error"] == "Syntax error"
+    assert json.loads(redis.values["error:key"]) == {
+        "error": "Syntax error",
+        "status": 400,
+    }
+    assert "lock:key" not in redis.values
+
+
+def test_unread_stream_is_stopped(monkeypatch):
+    store = px.Store()
+    for i in range(2000):
+        store.add(
+            px.Quad(
+                px.NamedNode(f"http://example.org/{i}"),
+                px.NamedNode("http://example.org/p"),
+                px.Literal(f"value {i}"),
+            )
+        )
+    monkeypatch.setattr(qry, "GRAPH", store)
+    monkeypatch.setattr(qry, "DATA_QUADS", len(store))
+    monkeypatch.setattr(qry, "ENDPOINT", None)
+    monkeypatch.setattr(qry, "STREAM_CHUNK_SIZE", 64)
+    monkeypatch.setattr(qry, "STREAM_BUFFER_CHUNKS", 1)
+    monkeypatch.setattr(qry, "QUERY_TIMEOUT", 0.3)
+    monkeypatch.setattr(config, "redis_client", None)
+    monkeypatch.setattr(limits, "MAX_CONCURRENT_QUERIES", 1)
+    monkeypatch.setattr(qry, "LIMITER", limits.Limiter())
+
+    async def run():
+        qry.REQUEST_MEMO.set(qry.RequestMemo("client"))
+        result = await qry.stream_query("SELECT * WHERE { ?s ?p ?o }", "csv")
+        assert "stream" in result
+        assert qry.LIMITER.running == {"client": 1}
+        # Nobody reads the stream, the worker is blocked on the full buffer
+        await asyncio.sleep(1)
+        assert qry.LIMITER.running == {}
+        assert qry.local_queries_pending == 0
+        assert not qry.STREAM_WATCHDOGS
+
+    asyncio.run(run())
+
+
+def test_load_store_keeps_ready_marker(tmp_path):
+    data = tmp_path / "data.nt"
+    data.write_text('<http://example.org/a> <http://example.org/p> "one" .\n')
+    store_path = str(tmp_path / "store")
+    ready = qry.load_store([str(data)], store_path)
+    assert ready["quads"] == 1
+    # Nothing changed, the marker stays the same and nobody reopens the store
+    assert qry.load_store([str(data)], store_path) == ready
+    assert read_ready(store_path) == ready
+    data.write_text('<http://example.org/a> <http://example.org/p> "two" .\n')
+    assert qry.load_store([str(data)], store_path)["version"] != ready["version"]
+
+
+def test_loaded_store_is_not_loaded_again(tmp_path, monkeypatch):
+    data = tmp_path / "data.nt"
+    data.write_text('<http://example.org/a> <http://example.org/p> "one" .\n')
+    store_path = str(tmp_path / "store")
+    monkeypatch.setattr(qry, "STARTED_AT", time.time())
+    # By another worker, that started at the same time
+    ready = qry.load_store([str(data)], store_path)
+    monkeypatch.setattr(qry, "GRAPH", None)
+    monkeypatch.setattr(qry, "DATA_QUADS", 0)
+    monkeypatch.setattr(qry, "DATA_VERSION", "")
+
+    def load_store(data_load_paths, store_path):
+        raise AssertionError("Loaded again")
+
+    monkeypatch.setattr(qry, "load_store", load_store)
+    qry.initialize_graph([str(data)], store_path)
+    assert len(qry.GRAPH) == 1
+    assert qry.DATA_VERSION == ready["version"]
+
+
+def test_unmarked_store_is_not_served(tmp_path, monkeypatch):
+    store_path = str(tmp_path / "store")
+    store = px.Store(store_path)
+    store.add(
+        px.Quad(
+            px.NamedNode("http://example.org/a"),
+            px.NamedNode("http://example.org/p"),
+            px.Literal("half loaded"),
+        )
+    )
+    del store
+    monkeypatch.setattr(qry, "GRAPH", None)
+    monkeypatch.setattr(qry, "DATA_QUADS", 0)
+    monkeypatch.setattr(qry, "DATA_VERSION", "")
+    qry.open_store(store_path, read_ready(store_path))
+    assert qry.GRAPH is None
+    monkeypatch.setattr(qry, "STORE_EXTERNAL", True)
+    qry.open_store(store_path, read_ready(store_path))
+    assert len(qry.GRAPH) == 1
+
+
+def test_timed_out_queries_keep_counting(monkeypatch):
+    monkeypatch.setattr(qry, "QUERY_TIMEOUT", 0.1)
+    monkeypatch.setattr(qry, "LOCAL_QUERY_WORKERS", 1)
+    monkeypatch.setattr(qry, "LOCAL_QUERY_QUEUE", 0)
+    stop = threading.Event()
+
+    def stuck(cancelled):
+        # A query pyoxigraph is still evaluating, before it yields a solution
+        stop.wait(5)
+        return {"error": "Query cancelled"}
+
+    async def run():
+        cancelled = threading.Event()
+        future = qry.submit_local_query(stuck, cancelled)
+        assert (await qry.await_local_query(future, cancelled))["status"] == 504
+        assert cancelled.is_set()
+        assert qry.local_queries_pending == 1
+        assert qry.submit_local_query(stuck, threading.Event()) is None
+        stop.set()
+        await asyncio.wrap_future(future)
+        await asyncio.sleep(0.01)
+        assert qry.local_queries_pending == 0
+
+    asyncio.run(run())
+
+
+class CancelledAfter:
+    "An event that is set once it has been checked the given number of times."
+
+    def __init__(self, checks: int):
+        self.checks = checks
+
+    def is_set(self) -> bool:
+        self.checks -= 1
+        return self.checks < 0
+
+
+def test_cancelled_query_stops_between_rows():
+    store = px.Store()
+    for i in range(10):
+        store.add(
+            px.Quad(
+                px.NamedNode(f"http://example.org/{i}"),
+                px.NamedNode("http://example.org/p"),
+                px.Literal(f"value {i}"),
+            )
+        )
+    solutions = store.query("SELECT * WHERE { ?s ?p ?o }")
+    with pytest.raises(QueryCancelled):
+        OxigraphSerialization(solutions).json(CancelledAfter(3))